@@ -0,0 +1,205 @@
+#
+#   Offline benchmark of the plugin hot paths against local Spotify and Domoticz
+#   stand-ins. Results are written as json, e.g.
+#
+#   python3 bench/benchmark.py --output bench_output.json
+#   python3 bench/benchmark.py --scenario many_devices --commands 50
+#
+
+import argparse
+import platform
+import tracemalloc
+import json
+import time
+import sys
+
+from mockservers import SpotifyMock, DomoticzMock, ConnectMock
+from harness import PluginInstance, summarise
+
+
+def checkBusyDebounce(instance, spotify, domoticz):
+    #A slider command for a key whose job is still running must not make the idle workers spin
+    volumeUnit = instance.plugin.accounts[0].unit(instance.module.VOLUME)
+    volumeCalls = spotify.requestCounts["PUT /v1/me/player/volume"]
+    spotify.latency = 3.0
+    startCpu = time.process_time()
+    start = time.perf_counter()
+    instance.onCommand(volumeUnit, "Set Level", 30)
+    #The first job is due after the debounce and then busy for the latency
+    time.sleep(0.7)
+    instance.onCommand(volumeUnit, "Set Level", 40)
+    instance.waitIdle()
+    floatCpuRatio = (time.process_time() - startCpu) / (time.perf_counter() - start)
+    spotify.latency = 0.0
+    intCalls = spotify.requestCounts["PUT /v1/me/player/volume"] - volumeCalls
+    return {"cpu_per_wall_s": floatCpuRatio, "volume_calls": intCalls, "passed": floatCpuRatio < 0.05 and intCalls == 2}
+
+
+def checkLocalListener(instance, spotify, domoticz):
+    #A speaker changing its active user must trigger exactly one playback poll
+    module = instance.module
+    connect = ConnectMock().start()
+    listener = module.ConnectListener(instance.plugin.localPlaybackChanged, module.MdnsBrowser(address=connect.mdnsAddress, timeout=0.3), infoInterval=0.2)
+    try:
+        listener.start()
+        blDiscovered = instance.waitFor(lambda: listener.states, 5)
+        for account in instance.plugin.accounts:
+            account.poller.nextPoll = time.time() + 1000
+        polls = spotify.requestCounts["GET /v1/me/player"]
+        connect.setActiveUser(1, "anna")
+        instance.waitFor(lambda: spotify.requestCounts["GET /v1/me/player"] > polls, 5)
+        #Later rounds without changes must not poll again
+        time.sleep(0.6)
+        instance.waitIdle()
+        intPolls = spotify.requestCounts["GET /v1/me/player"] - polls
+    finally:
+        listener.stop()
+        connect.stop()
+    return {"speakers_found": len(listener.devices), "polls": intPolls, "passed": bool(blDiscovered) and intPolls == 1}
+
+
+def checkPlaybackPlans(instance, spotify, domoticz):
+    #Plans search concurrently, the cache file must be written once per plan without errors
+    plugin = instance.plugin
+    lstSaves = []
+    save = plugin.searchCache.save
+
+    def countingSave(fileName):
+        lstSaves.append(fileName)
+        save(fileName)
+
+    plugin.searchCache.save = countingSave
+    intErrors = len(instance.errors())
+    intPlays = len(spotify.plays)
+    lstLevels = sorted(plugin.accounts[0].deviceRegistry.levelIds)
+    try:
+        for x in range(20):
+            instance.setSearch("; ".join(["playlist morning %s" % x, "artist band %s" % x, "album record %s" % x,
+                                          "track song %s" % x, "playlist evening %s" % x, "album other %s" % x]))
+            instance.onCommand(1, "Set Level", int(lstLevels[x % len(lstLevels)]))
+            instance.waitIdle()
+    finally:
+        plugin.searchCache.save = save
+
+    #The persisted cache must load completely
+    cache = instance.module.LruCache(len(plugin.searchCache.entries) + 1, 3600)
+    cache.load(plugin.searchCacheFile)
+    result = {"plans_played": len(spotify.plays) - intPlays,
+              "cache_saves": len(lstSaves),
+              "cache_entries_loaded": len(cache.entries),
+              "errors_logged": len(instance.errors()) - intErrors}
+    result["passed"] = (result["errors_logged"] == 0 and result["plans_played"] == 20 and result["cache_saves"] == 20
+                        and result["cache_entries_loaded"] == len(plugin.searchCache.entries))
+    return result
+
+
+SCENARIOS = {
+    "baseline": {"spotify": {}, "domoticz": {"extraVariables": 20}},
+    "many_devices": {"spotify": {"devices": 100}, "domoticz": {"extraVariables": 20}},
+    "many_variables": {"spotify": {}, "domoticz": {"extraVariables": 2000}},
+    "token_expiry": {"spotify": {"expiresIn": 2}, "domoticz": {"extraVariables": 20}, "waitExpiry": True},
+    "slow_network": {"spotify": {"latency": 0.05}, "domoticz": {"latency": 0.005, "extraVariables": 20}},
+    "flaky_spotify": {"spotify": {"errorRate": 0.05, "errorCode": 503}, "domoticz": {"extraVariables": 20}},
+    "local_listener": {"spotify": {}, "domoticz": {"extraVariables": 20}, "check": checkLocalListener},
+    "playback_plan": {"spotify": {}, "domoticz": {"extraVariables": 20}, "check": checkPlaybackPlans},
+    "busy_debounce": {"spotify": {}, "domoticz": {"extraVariables": 20}, "check": checkBusyDebounce},
+}
+
+
+def requestCounts(spotify, domoticz):
+    dictCounts = {}
+    for server in (spotify, domoticz):
+        dictCounts.update(server.requestCounts)
+    return dictCounts
+
+
+def runScenario(name, config, commands, heartbeats, verbose, transport):
+    spotify = SpotifyMock(**config["spotify"]).start()
+    domoticz = DomoticzMock(**config["domoticz"]).start()
+    tracemalloc.start()
+    try:
+        instance = PluginInstance(spotify, domoticz, verbose=verbose, transport=transport)
+        result = {}
+
+        start = time.perf_counter()
+        instance.onStart()
+        instance.waitStarted()
+        result["onStart_s"] = time.perf_counter() - start
+        result["onStart_requests"] = spotify.totalRequests() + domoticz.totalRequests()
+
+        instance.setSearch("playlist morning")
+        if config.get("waitExpiry"):
+            time.sleep(spotify.expiresIn + 0.5)
+
+        lstLatencies = []
+        lstLevels = sorted(instance.plugin.accounts[0].deviceRegistry.levelIds)[:2]
+        for x in range(commands):
+            level = lstLevels[x % len(lstLevels)]
+            playCount = len(spotify.plays)
+            start = time.perf_counter()
+            instance.onCommand(1, "Set Level", int(level))
+            if instance.waitFor(lambda: len(spotify.plays) > playCount):
+                lstLatencies.append(time.perf_counter() - start)
+            instance.waitIdle()
+        result["command_to_play_s"] = summarise(lstLatencies)
+        result["commands_failed"] = commands - len(lstLatencies)
+
+        lstCallback = []
+        lstTotal = []
+        for x in range(heartbeats):
+            for account in instance.plugin.accounts:
+                account.poller.nextPoll = 0
+            start = time.perf_counter()
+            instance.onHeartbeat()
+            lstCallback.append(time.perf_counter() - start)
+            instance.waitIdle()
+            lstTotal.append(time.perf_counter() - start)
+        result["heartbeat_callback_s"] = summarise(lstCallback)
+        result["heartbeat_total_s"] = summarise(lstTotal)
+
+        result["requests"] = requestCounts(spotify, domoticz)
+        result["requests_total"] = sum(result["requests"].values())
+        result["connections"] = spotify.connections + domoticz.connections
+        result["errors_logged"] = len(instance.errors())
+        result["memory_peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024.0
+        if config.get("check"):
+            result["check"] = config["check"](instance, spotify, domoticz)
+
+        instance.onStop()
+        return result
+    finally:
+        tracemalloc.stop()
+        spotify.stop()
+        domoticz.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Spotify plugin against local mock servers")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run, default all")
+    parser.add_argument("--commands", type=int, default=20, help="selector commands per scenario")
+    parser.add_argument("--heartbeats", type=int, default=20, help="polling heartbeats per scenario")
+    parser.add_argument("--output", help="write json results to this file instead of stdout")
+    parser.add_argument("--transport", choices=["pool", "domoticz"], default="pool", help="http transport of the plugin")
+    parser.add_argument("--verbose", action="store_true", help="show the plugin log")
+    args = parser.parse_args()
+
+    results = {"python": platform.python_version(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "commands": args.commands,
+               "heartbeats": args.heartbeats,
+               "transport": args.transport,
+               "scenarios": {}}
+    for name in args.scenario or sorted(SCENARIOS):
+        sys.stderr.write("Running scenario %s\n" % (name))
+        results["scenarios"][name] = runScenario(name, SCENARIOS[name], args.commands, args.heartbeats, args.verbose, args.transport)
+
+    strResults = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(strResults + "\n")
+    else:
+        print(strResults)
+
+
+if __name__ == "__main__":
+    main()
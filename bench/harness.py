@@ -0,0 +1,127 @@
+#
+#   Helpers to run plugin.py outside of Domoticz against the local mock servers.
+#   Every PluginInstance loads its own copy of plugin.py and fakeDomoticz, so
+#   many instances (each with its own Parameters and Devices) can share a process.
+#
+
+import importlib.util
+import itertools
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_instanceCounter = itertools.count()
+
+
+def loadModule(name, fileName):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, fileName))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class PluginInstance:
+    """One plugin hardware entry wired to a SpotifyMock and DomoticzMock"""
+
+    def __init__(self, spotify, domoticz, name=None, parameters=None, verbose=False, transport="pool"):
+        number = next(_instanceCounter)
+        self.name = name or "spotify%s" % (number)
+        self.spotify = spotify
+        self.domoticz = domoticz
+        self.homeFolder = tempfile.mkdtemp(prefix="spotifybench")
+
+        self.fake = loadModule("fakeDomoticz_%s" % (number), "fakeDomoticz.py")
+        self.fake.Verbose = verbose
+        self.fake.Parameters.update({"Name": self.name,
+                                     "HomeFolder": self.homeFolder + os.sep,
+                                     "Address": "127.0.0.1",
+                                     "Port": str(domoticz.port),
+                                     "Mode1": "clientid",
+                                     "Mode2": "clientsecret",
+                                     "Mode3": "authorisationcode",
+                                     "Mode5": "10",
+                                     "Mode6": "Normal"})
+        if parameters:
+            self.fake.Parameters.update(parameters)
+
+        #plugin.py imports fakeDomoticz when Domoticz is not available
+        previous = sys.modules.get("fakeDomoticz")
+        sys.modules["fakeDomoticz"] = self.fake
+        try:
+            self.module = loadModule("spotify_plugin_%s" % (number), "plugin.py")
+        finally:
+            if previous is None:
+                del sys.modules["fakeDomoticz"]
+            else:
+                sys.modules["fakeDomoticz"] = previous
+
+        #Connection callbacks of this fakeDomoticz copy go to this plugin copy
+        self.fake.Plugin = self.module
+        if transport == "domoticz":
+            self.module.HTTP_TRANSPORT = transport
+            self.module._httpPool = self.module.DomoticzTransport()
+            self.module._spotifyApi.pool = self.module._httpPool
+
+        self.plugin = self.module._plugin
+        self.plugin.spotifyAccountUrl = spotify.accountUrl
+        self.plugin.spotifyApiUrl = spotify.apiUrl
+
+    @property
+    def Devices(self):
+        return self.fake.Devices
+
+    def setSearch(self, searchTxt):
+        self.domoticz.setVariable(self.name + "-searchTxt", searchTxt)
+
+    def errors(self):
+        return [message for (stamp, level, message) in self.fake.Messages if level == "Error"]
+
+    def waitIdle(self, timeout=30):
+        return self.plugin.commandQueue.waitIdle(timeout)
+
+    def waitStarted(self, timeout=30):
+        return self.waitFor(lambda: not self.plugin.blStarting, timeout)
+
+    def waitFor(self, condition, timeout=30):
+        end = time.time() + timeout
+        while time.time() < end:
+            if condition():
+                return True
+            time.sleep(0.001)
+        return False
+
+    def onStart(self):
+        self.module.onStart()
+
+    def onStop(self):
+        self.module.onStop()
+        shutil.rmtree(self.homeFolder, ignore_errors=True)
+
+    def onHeartbeat(self):
+        self.module.onHeartbeat()
+
+    def onCommand(self, Unit, Command, Level, Hue=""):
+        self.module.onCommand(Unit, Command, Level, Hue)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    lstSorted = sorted(values)
+    index = min(len(lstSorted) - 1, int(round(fraction * (len(lstSorted) - 1))))
+    return lstSorted[index]
+
+
+def summarise(values):
+    if not values:
+        return {"count": 0}
+    return {"count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": max(values)}
@@ -0,0 +1,203 @@
+#
+#   Load test: many plugin instances (hardware entries) in one process against one
+#   Spotify and one Domoticz mock server, each driven by its own thread with
+#   heartbeats and commands at configurable rates. Reports aggregate requests per
+#   second, tail latencies and rate limit hits as json, e.g.
+#
+#   python3 bench/loadtest.py --instances 30 --duration 60
+#   python3 bench/loadtest.py --instances 50 --poll-interval 5 --spotify-rate-limit 20
+#
+
+import argparse
+import platform
+import threading
+import random
+import json
+import time
+import sys
+
+from mockservers import SpotifyMock, DomoticzMock
+from harness import PluginInstance, summarise
+
+
+class InstanceDriver:
+    """Calls onHeartbeat every heartbeatInterval seconds and sends selector commands
+    with exponentially distributed gaps (commandRate per second) to one instance,
+    like Domoticz does on the plugin thread. Every request the plugin records in its
+    metrics is also kept here with its exact latency."""
+
+    def __init__(self, instance, heartbeatInterval, commandRate, seed):
+        self.instance = instance
+        self.heartbeatInterval = heartbeatInterval
+        self.commandRate = commandRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.heartbeats = []
+        self.commands = []
+        self.pendingCommands = []
+        self.commandsSent = 0
+        self.stopAt = 0
+        self.thread = None
+
+        metrics = instance.module._metrics
+        self.record = metrics.record
+        metrics.record = self.recordRequest
+
+    def recordRequest(self, endpoint, status, seconds):
+        self.record(endpoint, status, seconds)
+        with self.lock:
+            self.requests.append((endpoint, str(status), seconds))
+            if endpoint == 'PUT /v1/me/player/play' and str(status).startswith('2'):
+                now = time.perf_counter()
+                self.commands.extend(now - sent for sent in self.pendingCommands)
+                self.pendingCommands = []
+
+    def setPollInterval(self, seconds):
+        module = self.instance.module
+        module.POLL_MIN_INTERVAL = module.POLL_FAST_INTERVAL = module.POLL_IDLE_START = seconds
+        for account in self.instance.plugin.accounts:
+            account.poller.maxInterval = seconds
+
+    def start(self, duration):
+        self.stopAt = time.perf_counter() + duration
+        self.thread = threading.Thread(target=self.run, name="driver " + self.instance.name)
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def sendCommand(self):
+        lstLevels = sorted(self.instance.plugin.accounts[0].deviceRegistry.levelIds)
+        if not lstLevels:
+            return
+        with self.lock:
+            self.pendingCommands.append(time.perf_counter())
+        self.commandsSent += 1
+        self.instance.onCommand(1, "Set Level", int(self.random.choice(lstLevels)))
+
+    def run(self):
+        #Spread the first heartbeats, all instances starting at once is not what Domoticz does
+        now = time.perf_counter()
+        nextHeartbeat = now + self.random.uniform(0, self.heartbeatInterval)
+        nextCommand = now + self.random.expovariate(self.commandRate) if self.commandRate else float('inf')
+        while True:
+            due = min(nextHeartbeat, nextCommand)
+            if due >= self.stopAt:
+                break
+            time.sleep(max(0, due - time.perf_counter()))
+            if nextHeartbeat <= nextCommand:
+                start = time.perf_counter()
+                self.instance.onHeartbeat()
+                self.heartbeats.append(time.perf_counter() - start)
+                nextHeartbeat += self.heartbeatInterval
+            else:
+                self.sendCommand()
+                nextCommand += self.random.expovariate(self.commandRate)
+
+
+def latencies(lstRequests, domoticz):
+    #Calls suspended by the circuit breaker never reached the server
+    return summarise([seconds for endpoint, status, seconds in lstRequests
+                      if endpoint.startswith("GET json.htm") == domoticz and status != "suspended"])
+
+
+def runLoadTest(args):
+    spotifyOptions = {"devices": args.devices, "expiresIn": args.token_expiry, "latency": args.spotify_latency,
+                      "rateLimit": args.spotify_rate_limit, "retryAfter": args.retry_after}
+    spotify = SpotifyMock(**spotifyOptions).start()
+    domoticz = DomoticzMock(extraVariables=args.variables, latency=args.domoticz_latency).start()
+    lstDrivers = []
+    try:
+        lstStart = []
+        for x in range(args.instances):
+            instance = PluginInstance(spotify, domoticz, verbose=args.verbose, transport=args.transport)
+            instance.setSearch("playlist morning")
+            start = time.perf_counter()
+            instance.onStart()
+            instance.waitStarted()
+            lstStart.append(time.perf_counter() - start)
+            driver = InstanceDriver(instance, args.heartbeat_interval, args.command_rate, args.seed + x)
+            driver.setPollInterval(args.poll_interval)
+            lstDrivers.append(driver)
+
+        #Only the steady state is measured
+        spotify.resetCounts()
+        domoticz.resetCounts()
+        for driver in lstDrivers:
+            with driver.lock:
+                del driver.requests[:]
+        start = time.perf_counter()
+        for driver in lstDrivers:
+            driver.start(args.duration)
+        for driver in lstDrivers:
+            driver.join()
+        for driver in lstDrivers:
+            driver.instance.waitIdle()
+        elapsed = time.perf_counter() - start
+
+        lstRequests = [request for driver in lstDrivers for request in driver.requests]
+        intSpotify = spotify.totalRequests()
+        intDomoticz = domoticz.totalRequests()
+        result = {"elapsed_s": elapsed,
+                  "onStart_s": summarise(lstStart),
+                  "requests_per_s": {"spotify": intSpotify / elapsed,
+                                     "domoticz": intDomoticz / elapsed,
+                                     "total": (intSpotify + intDomoticz) / elapsed},
+                  "requests": dict(spotify.requestCounts, **domoticz.requestCounts),
+                  "status": {"spotify": dict(spotify.statusCounts), "domoticz": dict(domoticz.statusCounts)},
+                  "latency_s": {"spotify_request": latencies(lstRequests, False),
+                                "domoticz_request": latencies(lstRequests, True),
+                                "heartbeat_callback": summarise([seconds for driver in lstDrivers for seconds in driver.heartbeats]),
+                                "command_to_play": summarise([seconds for driver in lstDrivers for seconds in driver.commands])},
+                  "rate_limit": {"server_429": spotify.statusCounts["429"],
+                                 "client_429": sum(1 for endpoint, status, seconds in lstRequests if status == "429"),
+                                 "suspended_calls": sum(1 for endpoint, status, seconds in lstRequests if status == "suspended")},
+                  "commands_sent": sum(driver.commandsSent for driver in lstDrivers),
+                  "heartbeats": sum(len(driver.heartbeats) for driver in lstDrivers),
+                  "connections": spotify.connections + domoticz.connections,
+                  "errors_logged": sum(len(driver.instance.errors()) for driver in lstDrivers)}
+        return result
+    finally:
+        for driver in lstDrivers:
+            driver.instance.onStop()
+        spotify.stop()
+        domoticz.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test many Spotify plugin instances against one Spotify and Domoticz mock")
+    parser.add_argument("--instances", type=int, default=20, help="plugin instances (hardware entries)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load after all instances started")
+    parser.add_argument("--heartbeat-interval", type=float, default=10, help="seconds between heartbeats per instance")
+    parser.add_argument("--command-rate", type=float, default=0.05, help="selector commands per second per instance")
+    parser.add_argument("--poll-interval", type=float, default=10, help="playback poll interval of the plugin in seconds")
+    parser.add_argument("--token-expiry", type=int, default=3600, help="lifetime of the spotify access tokens in seconds")
+    parser.add_argument("--spotify-rate-limit", type=int, help="spotify requests per second over all instances before 429")
+    parser.add_argument("--retry-after", type=int, help="Retry-After seconds of the spotify 429 responses, default 1")
+    parser.add_argument("--spotify-latency", type=float, default=0.0, help="seconds added to every spotify request")
+    parser.add_argument("--domoticz-latency", type=float, default=0.0, help="seconds added to every domoticz request")
+    parser.add_argument("--devices", type=int, default=5, help="spotify connect devices")
+    parser.add_argument("--variables", type=int, default=20, help="other user variables in domoticz")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the command timing")
+    parser.add_argument("--transport", choices=["pool", "domoticz"], default="pool", help="http transport of the plugin")
+    parser.add_argument("--output", help="write json results to this file instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="show the plugin log")
+    args = parser.parse_args()
+
+    sys.stderr.write("Running %s instances for %s seconds\n" % (args.instances, args.duration))
+    results = {"python": platform.python_version(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "config": vars(args),
+               "results": runLoadTest(args)}
+
+    strResults = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(strResults + "\n")
+    else:
+        print(strResults)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+#
+#   Local stand-ins for the Spotify accounts/Web API and the Domoticz json api,
+#   with configurable latency and error injection. Used by the benchmark and
+#   load test harness, no network access needed.
+#
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import urllib.parse
+import socket
+import struct
+import collections
+import threading
+import random
+import json
+import time
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        #Headers and body are written separately, avoid the delayed ack stall
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.countConnection()
+
+    def handleRequest(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        parsedUrl = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parsedUrl.query, keep_blank_values=True))
+
+        status, headers, payload = self.server.dispatch(self.command, parsedUrl.path, query, self.headers, body)
+
+        data = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = handleRequest
+    do_PUT = handleRequest
+    do_POST = handleRequest
+    do_DELETE = handleRequest
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """Threaded http server on a free local port. Subclasses implement respond(),
+    every request is delayed by latency seconds and fails with errorCode with
+    probability errorRate. With rateLimit more than that many requests within one
+    second, counted over all clients, answer 429 like Spotify's app wide limit."""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, errorRate=0.0, errorCode=503, retryAfter=None, rateLimit=None):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), MockHandler)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.errorCode = errorCode
+        self.retryAfter = retryAfter
+        self.rateLimit = rateLimit
+        self.recentRequests = collections.deque()
+        self.lock = threading.Lock()
+        self.requestCounts = collections.Counter()
+        self.statusCounts = collections.Counter()
+        self.connections = 0
+        self.thread = None
+
+    @property
+    def baseUrl(self):
+        return "http://127.0.0.1:%s" % (self.server_address[1])
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def countConnection(self):
+        with self.lock:
+            self.connections += 1
+
+    def resetCounts(self):
+        with self.lock:
+            self.requestCounts.clear()
+            self.statusCounts.clear()
+            self.connections = 0
+
+    def totalRequests(self):
+        with self.lock:
+            return sum(self.requestCounts.values())
+
+    def overRateLimit(self):
+        if not self.rateLimit:
+            return False
+        now = time.time()
+        with self.lock:
+            while self.recentRequests and self.recentRequests[0] <= now - 1:
+                self.recentRequests.popleft()
+            if len(self.recentRequests) >= self.rateLimit:
+                return True
+            self.recentRequests.append(now)
+        return False
+
+    def dispatch(self, method, path, query, headers, body):
+        with self.lock:
+            self.requestCounts["%s %s" % (method, self.endpointName(path, query))] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.overRateLimit():
+            result = 429, {"Retry-After": str(self.retryAfter or 1)}, {"error": {"status": 429, "message": "API rate limit exceeded"}}
+        elif self.errorRate and random.random() < self.errorRate:
+            dictHeaders = {}
+            if self.errorCode == 429 and self.retryAfter is not None:
+                dictHeaders["Retry-After"] = str(self.retryAfter)
+            result = self.errorCode, dictHeaders, {"error": {"status": self.errorCode, "message": "injected error"}}
+        else:
+            result = self.respond(method, path, query, headers, body)
+        with self.lock:
+            self.statusCounts[str(result[0])] += 1
+        return result
+
+    def endpointName(self, path, query):
+        return path
+
+    def respond(self, method, path, query, headers, body):
+        return 404, {}, {"error": {"status": 404, "message": "not found"}}
+
+
+class SpotifyMock(MockServer):
+    """Spotify accounts (/api/token) and Web API (/v1/...) on one server. Access
+    tokens expire after expiresIn seconds, after which api calls answer 401. With
+    coldDevices the first play on a device that was not transferred to answers 404,
+    like a speaker that is still waking up."""
+
+    def __init__(self, devices=5, expiresIn=3600, searchResults=10, favourites=30, coldDevices=False, **kwargs):
+        MockServer.__init__(self, **kwargs)
+        self.coldDevices = coldDevices
+        self.awake = set()
+        self.expiresIn = expiresIn
+        self.searchResults = searchResults
+        self.favourites = favourites
+        self.tokens = {}
+        self.tokenCounter = 0
+        self.devices = [{"id": "device%s" % x, "name": "Speaker %s" % x, "type": "Speaker", "is_active": False, "volume_percent": 50} for x in range(devices)]
+        self.player = None
+        self.plays = []
+
+    @property
+    def accountUrl(self):
+        return self.baseUrl + "/api/token"
+
+    @property
+    def apiUrl(self):
+        return self.baseUrl + "/v1"
+
+    def endpointName(self, path, query):
+        if path == "/v1/search":
+            return path + "?type=" + query.get("type", "")
+        if path.startswith(("/v1/playlists/", "/v1/albums/", "/v1/artists/")):
+            parts = path.split("/")
+            parts[3] = "{id}"
+            return "/".join(parts)
+        return path
+
+    def newToken(self):
+        with self.lock:
+            self.tokenCounter += 1
+            accessToken = "access%s" % (self.tokenCounter)
+            self.tokens[accessToken] = time.time() + self.expiresIn
+        return {"access_token": accessToken, "token_type": "Bearer", "expires_in": self.expiresIn,
+                "refresh_token": "refresh", "scope": "user-read-playback-state user-modify-playback-state"}
+
+    def authorised(self, headers):
+        accessToken = (headers.get("Authorization") or "")[len("Bearer "):]
+        expires = self.tokens.get(accessToken)
+        return expires is not None and expires > time.time()
+
+    def deviceById(self, deviceId):
+        for device in self.devices:
+            if device["id"] == deviceId:
+                return device
+        return None
+
+    def searchItem(self, type, query, x):
+        item = {"id": "%s%s" % (type, x), "name": "%s %s %s" % (query, type, x), "uri": "spotify:%s:%s%s" % (type, type, x),
+                "type": type, "popularity": 50, "href": "https://api.spotify.com/v1/%ss/%s%s" % (type, type, x),
+                "external_urls": {"spotify": "https://open.spotify.com/%s/%s%s" % (type, type, x)},
+                "images": [{"url": "https://i.scdn.co/image/%s" % (y), "height": 640, "width": 640} for y in range(3)]}
+        if type in ("track", "album"):
+            item["artists"] = [{"id": "artist0", "name": "Artist %s" % (query), "uri": "spotify:artist:artist0"}]
+            item["available_markets"] = ["NL", "BE", "DE", "FR", "GB", "US", "SE", "NO", "DK", "FI"] * 8
+        if type == "track":
+            item["duration_ms"] = 200000
+            item["album"] = {"name": "Album %s" % (x), "uri": "spotify:album:album%s" % (x), "images": item["images"]}
+        return item
+
+    def favouritesPage(self, path, query):
+        """Paged playlists, saved albums or followed artists, favourites of each"""
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 20))
+        if path == "/v1/me/albums":
+            items = [{"added_at": "2020-01-01T00:00:00Z", "album": self.searchItem("album", "Saved", x)} for x in range(offset, min(offset + limit, self.favourites))]
+        else:
+            type = "playlist" if path == "/v1/me/playlists" else "artist"
+            items = [self.searchItem(type, "Favourite", x) for x in range(offset, min(offset + limit, self.favourites))]
+        nextUrl = None
+        if offset + limit < self.favourites:
+            nextQuery = dict(query, offset=offset + limit, limit=limit)
+            nextUrl = self.apiUrl + path[len("/v1"):] + "?" + urllib.parse.urlencode(nextQuery)
+        page = {"href": "", "items": items, "limit": limit, "offset": offset, "total": self.favourites, "next": nextUrl}
+        if path == "/v1/me/following":
+            return {"artists": page}
+        return page
+
+    def respond(self, method, path, query, headers, body):
+        if path == "/api/token":
+            return 200, {}, self.newToken()
+
+        if not path.startswith("/v1/"):
+            return 404, {}, {"error": {"status": 404, "message": "not found"}}
+        if not self.authorised(headers):
+            return 401, {}, {"error": {"status": 401, "message": "The access token expired"}}
+
+        if path == "/v1/me/player/devices":
+            return 200, {}, {"devices": self.devices}
+
+        if path == "/v1/search":
+            type = query.get("type", "track")
+            limit = int(query.get("limit", 20))
+            items = [self.searchItem(type, query.get("q", ""), x) for x in range(min(limit, self.searchResults))]
+            return 200, {}, {type + "s": {"href": "", "items": items, "limit": limit, "offset": 0, "total": len(items)}}
+
+        if path.startswith(("/v1/playlists/", "/v1/albums/")) and path.endswith("/tracks"):
+            id = path.split("/")[3]
+            limit = int(query.get("limit", 20))
+            tracks = [self.searchItem("track", id, "%s_%s" % (id, x)) for x in range(min(limit, self.searchResults))]
+            if path.startswith("/v1/playlists/"):
+                return 200, {}, {"items": [{"added_at": "2020-01-01T00:00:00Z", "track": track} for track in tracks]}
+            return 200, {}, {"items": tracks, "limit": limit, "offset": 0, "total": len(tracks)}
+
+        if path.startswith("/v1/artists/") and path.endswith("/top-tracks"):
+            id = path.split("/")[3]
+            return 200, {}, {"tracks": [self.searchItem("track", id, "%s_%s" % (id, x)) for x in range(self.searchResults)]}
+
+        if path in ("/v1/me/playlists", "/v1/me/albums", "/v1/me/following"):
+            return 200, {}, self.favouritesPage(path, query)
+
+        if path == "/v1/me/player" and method == "GET":
+            if self.player is None:
+                return 204, {}, None
+            return 200, {}, self.player
+
+        if path == "/v1/me/player" and method == "PUT":
+            request = json.loads(body.decode("utf-8")) if body else {}
+            device = self.deviceById((request.get("device_ids") or [None])[0])
+            if device is None:
+                return 404, {}, {"error": {"status": 404, "message": "Device not found"}}
+            with self.lock:
+                self.awake.add(device["id"])
+            if self.player is not None:
+                self.player["device"] = dict(device, is_active=True)
+            return 204, {}, None
+
+        if path == "/v1/me/player/play" and method == "PUT":
+            device = self.deviceById(query.get("device_id"))
+            if device is None:
+                return 404, {}, {"error": {"status": 404, "message": "Device not found"}}
+            with self.lock:
+                blCold = self.coldDevices and device["id"] not in self.awake
+                self.awake.add(device["id"])
+            if blCold:
+                return 404, {}, {"error": {"status": 404, "message": "Device not found"}}
+            request = json.loads(body.decode("utf-8")) if body else {}
+            uri = request.get("context_uri") or (request.get("uris") or [None])[0]
+            self.plays.append((time.time(), device["id"], request))
+            self.player = {"device": dict(device, is_active=True), "shuffle_state": False, "repeat_state": "off",
+                           "timestamp": int(time.time() * 1000), "progress_ms": 0, "is_playing": True,
+                           "item": {"name": "Track", "uri": uri, "duration_ms": 200000, "artists": [{"name": "Artist"}]},
+                           "currently_playing_type": "track"}
+            return 204, {}, None
+
+        if path in ("/v1/me/player/volume", "/v1/me/player/shuffle", "/v1/me/player/repeat", "/v1/me/player/seek",
+                    "/v1/me/player/next", "/v1/me/player/previous"):
+            if self.player is None:
+                return 404, {}, {"error": {"status": 404, "message": "Player command failed: No active device found"}}
+            if path.endswith("/volume"):
+                self.player["device"]["volume_percent"] = int(query.get("volume_percent", 0))
+            elif path.endswith("/shuffle"):
+                self.player["shuffle_state"] = query.get("state") == "true"
+            elif path.endswith("/repeat"):
+                self.player["repeat_state"] = query.get("state", "off")
+            elif path.endswith("/seek"):
+                self.player["progress_ms"] = int(query.get("position_ms", 0))
+            else:
+                self.player["progress_ms"] = 0
+            return 204, {}, None
+
+        if path == "/v1/me/player/pause" and method == "PUT":
+            if self.player is not None:
+                self.player["is_playing"] = False
+            return 204, {}, None
+
+        return 404, {}, {"error": {"status": 404, "message": "Service not found"}}
+
+
+def dnsName(name):
+    return b"".join(bytes([len(label)]) + label.encode("utf-8") for label in name.split(".")) + b"\0"
+
+
+def dnsRecord(name, rrType, rdata):
+    return dnsName(name) + struct.pack("!HHIH", rrType, 0x8001, 120, len(rdata)) + rdata
+
+
+class ConnectMock(MockServer):
+    """Spotify Connect speakers on the local network: answers mDNS PTR queries for
+    _spotify-connect._tcp.local on a udp socket (send queries to mdnsAddress) and
+    serves the zeroconf getInfo endpoint of every speaker over http."""
+
+    SERVICE = "_spotify-connect._tcp.local"
+
+    def __init__(self, speakers=2, **kwargs):
+        MockServer.__init__(self, **kwargs)
+        self.infos = [{"status": 101, "statusString": "OK", "spotifyError": 0, "version": "2.7.1",
+                       "deviceID": "device%s" % x, "remoteName": "Speaker %s" % x, "activeUser": "",
+                       "deviceType": "SPEAKER", "availability": "", "groupStatus": "NONE"} for x in range(speakers)]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.udpThread = None
+        self.queries = 0
+
+    @property
+    def mdnsAddress(self):
+        return self.udp.getsockname()
+
+    def start(self):
+        MockServer.start(self)
+        self.udpThread = threading.Thread(target=self.answerQueries, name="ConnectMockMdns")
+        self.udpThread.daemon = True
+        self.udpThread.start()
+        return self
+
+    def stop(self):
+        MockServer.stop(self)
+        self.udp.close()
+
+    def setActiveUser(self, x, user):
+        with self.lock:
+            self.infos[x]["activeUser"] = user
+
+    def answer(self):
+        records = []
+        for x in range(len(self.infos)):
+            instance = "Speaker%s.%s" % (x, self.SERVICE)
+            host = "speaker%s.local" % (x)
+            records.append(dnsRecord(self.SERVICE, 12, dnsName(instance)))
+            records.append(dnsRecord(instance, 33, struct.pack("!HHH", 0, 0, self.port) + dnsName(host)))
+            txt = b"".join(bytes([len(entry)]) + entry for entry in (b"VERSION=1.0", ("CPath=/zc/%s" % (x)).encode("ascii")))
+            records.append(dnsRecord(instance, 16, txt))
+            records.append(dnsRecord(host, 1, socket.inet_aton("127.0.0.1")))
+        return struct.pack("!HHHHHH", 0, 0x8400, 0, len(records), 0, 0) + b"".join(records)
+
+    def answerQueries(self):
+        while True:
+            try:
+                data, source = self.udp.recvfrom(9000)
+            except OSError:
+                return
+            if dnsName(self.SERVICE) in data:
+                with self.lock:
+                    self.queries += 1
+                self.udp.sendto(self.answer(), source)
+
+    def respond(self, method, path, query, headers, body):
+        if path.startswith("/zc/") and query.get("action") == "getInfo":
+            with self.lock:
+                return 200, {}, dict(self.infos[int(path[len("/zc/"):])])
+        return 404, {}, None
+
+
+class DomoticzMock(MockServer):
+    """Domoticz json.htm user variable api, optionally filled with extra variables"""
+
+    def __init__(self, extraVariables=0, **kwargs):
+        MockServer.__init__(self, **kwargs)
+        self.variables = collections.OrderedDict()
+        self.nextIdx = 1
+        for x in range(extraVariables):
+            self.setVariable("othervariable%s" % (x), "value %s" % (x))
+
+    def endpointName(self, path, query):
+        return path + "?param=" + query.get("param", "")
+
+    def setVariable(self, name, value):
+        with self.lock:
+            variable = self.variables.get(name)
+            if variable is None:
+                variable = {"idx": str(self.nextIdx), "Name": name, "Type": "2", "Value": value}
+                self.nextIdx += 1
+                self.variables[name] = variable
+            variable["Value"] = value
+            variable["LastUpdate"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def respond(self, method, path, query, headers, body):
+        if path != "/json.htm":
+            return 404, {}, None
+
+        param = query.get("param")
+        if param == "getuservariables":
+            with self.lock:
+                result = [dict(variable) for variable in self.variables.values()]
+            if not result:
+                return 200, {}, {"status": "OK", "title": "GetUserVariables"}
+            return 200, {}, {"status": "OK", "title": "GetUserVariables", "result": result}
+
+        if param == "getuservariable":
+            with self.lock:
+                result = [dict(variable) for variable in self.variables.values() if variable["idx"] == query.get("idx")]
+            if not result:
+                return 200, {}, {"status": "ERR", "title": "GetUserVariable"}
+            return 200, {}, {"status": "OK", "title": "GetUserVariable", "result": result}
+
+        if param in ("saveuservariable", "updateuservariable"):
+            self.setVariable(query.get("vname"), query.get("vvalue", ""))
+            return 200, {}, {"status": "OK", "title": param}
+
+        return 200, {}, {"status": "OK"}
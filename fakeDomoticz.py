@@ -0,0 +1,195 @@
+#
+#   Stand-in for the Domoticz python framework, used when running plugin.py
+#   outside of Domoticz (local testing, benchmark and load test harness)
+#
+
+import http.client
+import threading
+import queue
+import ssl
+import sys
+import time
+
+Parameters = {"Name": "spotify",
+              "HomeFolder": "./",
+              "Address": "localhost",
+              "Port": "8080",
+              "Username": "",
+              "Password": "",
+              "Mode1": "",
+              "Mode2": "",
+              "Mode3": "",
+              "Mode4": "",
+              "Mode5": "10",
+              "Mode6": "Debug"}
+
+Devices = {}
+
+#Set to False to silence the log output, messages are always kept in Messages
+Verbose = True
+Messages = []
+HeartbeatInterval = 10
+
+#Module whose onConnect/onMessage/onDisconnect receive the Connection callbacks,
+#defaults to the script being run (python3 plugin.py)
+Plugin = None
+
+
+def _log(level, message):
+    Messages.append((time.time(), level, str(message)))
+    if Verbose:
+        print("%s %s: %s" % (time.strftime("%H:%M:%S"), level, message))
+
+def Log(message):
+    _log("Log", message)
+
+def Status(message):
+    _log("Status", message)
+
+def Error(message):
+    _log("Error", message)
+
+def Debug(message):
+    _log("Debug", message)
+
+def Heartbeat(interval):
+    global HeartbeatInterval
+    HeartbeatInterval = interval
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Used=0, Options=None, Image=0, Description=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Used = Used
+        self.Options = Options or {}
+        self.Image = Image
+        self.Description = Description
+        self.nValue = 0
+        self.sValue = ""
+        self.LastUpdate = ""
+        self.UpdateCount = 0
+
+    def Create(self):
+        Devices[self.Unit] = self
+        Log("Device %s created with unit %s" % (self.Name, self.Unit))
+
+    def Update(self, nValue=None, sValue=None, Options=None, Image=None, **kwargs):
+        if nValue is not None:
+            self.nValue = nValue
+        if sValue is not None:
+            self.sValue = sValue
+        if Options is not None:
+            self.Options = Options
+        if Image is not None:
+            self.Image = Image
+        self.LastUpdate = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.UpdateCount += 1
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+
+class _CallbackThread:
+    """Delivers the connection callbacks one at a time on a single thread, like the
+    Domoticz plugin thread does"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def post(self, name, *args):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="FakeDomoticzPlugin")
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((name, args))
+
+    def run(self):
+        while True:
+            name, args = self.queue.get()
+            plugin = Plugin or sys.modules.get("__main__")
+            callback = getattr(plugin, name, None)
+            if callback is None:
+                continue
+            try:
+                callback(*args)
+            except Exception as error:
+                Error("Exception in %s: %s" % (name, error))
+
+
+_callbacks = _CallbackThread()
+
+
+class Connection:
+    """Simulates Domoticz.Connection for the HTTP and HTTPS protocols on real sockets.
+    Connect() and Send() return at once, the network work happens on a thread per
+    connection and onConnect, onMessage and onDisconnect are called on the callback
+    thread, with Data as {"Status", "Headers", "Data"} like the Domoticz HTTP protocol."""
+
+    def __init__(self, Name="", Transport="TCP/IP", Protocol="HTTP", Address="", Port="80", Baud=None):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.conn = None
+        self.state = "Disconnected"
+        self.sends = queue.Queue()
+        self.thread = None
+
+    def Connected(self):
+        return self.state == "Connected"
+
+    def Connecting(self):
+        return self.state == "Connecting"
+
+    def Connect(self):
+        self.state = "Connecting"
+        self.thread = threading.Thread(target=self.run, name="FakeConnection " + self.Name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Send(self, Message, Delay=0):
+        self.sends.put(Message)
+
+    def Disconnect(self):
+        self.sends.put(None)
+
+    def run(self):
+        try:
+            if self.Protocol == "HTTPS":
+                self.conn = http.client.HTTPSConnection(self.Address, int(self.Port), timeout=30, context=ssl.create_default_context())
+            else:
+                self.conn = http.client.HTTPConnection(self.Address, int(self.Port), timeout=30)
+            self.conn.connect()
+        except OSError as error:
+            self.state = "Disconnected"
+            _callbacks.post("onConnect", self, 1, str(error))
+            return
+
+        self.state = "Connected"
+        _callbacks.post("onConnect", self, 0, "")
+        while True:
+            message = self.sends.get()
+            if message is None:
+                break
+            try:
+                self.conn.request(message.get("Verb", "GET"), message.get("URL", "/"), body=message.get("Data"), headers=message.get("Headers") or {})
+                response = self.conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                break
+            _callbacks.post("onMessage", self, {"Status": str(response.status), "Headers": dict(response.getheaders()), "Data": body})
+            if response.will_close:
+                break
+
+        self.conn.close()
+        self.state = "Disconnected"
+        _callbacks.post("onDisconnect", self)
@@ -6,14 +6,15 @@
 #
 
 """
-<plugin key="Spotify" name="Spotify Plugin" author="djj" version="0.2" wikilink="https://github.com/DaanJJansen/domoticz-spotify" externallink="https://api.spotify.com">
+<plugin key="Spotify" name="Spotify Plugin" author="djj" version="0.3" wikilink="https://github.com/DaanJJansen/domoticz-spotify" externallink="https://api.spotify.com">
     <params>
         <param field="Address" label="Domoticz IP Address" width="200px" required="true" default="localhost"/>
         <param field="Port" label="Port" width="40px" required="true" default="8080"/>
         <param field="Mode1" label="Client ID" width="200px" required="true" default=""/>
         <param field="Mode2" label="Client Secret" width="200px" required="true" default=""/>
         <param field="Mode3" label="Code" width="400px" required="true" default=""/>
-        <param field="Mode5" label="Poll intervall" width="100px" required="true">
+        <param field="Mode4" label="Extra accounts (name:code,...)" width="400px" required="false" default=""/>
+        <param field="Mode5" label="Max poll intervall" width="100px" required="true">
             <options>
                 <option label="None" value=0/>
                 <option label="30 seconds" value=1/>
@@ -43,126 +44,1804 @@ except ImportError:
     from fakeDomoticz import Parameters
 
 
-import urllib.request
 import urllib.error
 import urllib.parse
+import http.client
+import threading
+import collections
 import base64
 import json
 import time
+import random
+import os
+import ssl
+import io
+import re
+import bisect
+import difflib
+import socket
+import struct
 
 #DEFINES
 SPOTIFYDEVICES = 1
+NOWPLAYING = 2
+VOLUME = 3
+SHUFFLE = 4
+REPEAT = 5
+PROGRESS = 6
+NEXT = 7
+PREVIOUS = 8
+SEEK = 9
+REPEAT_LEVELS = {'off': '0', 'track': '10', 'context': '20'}
+UNITS_PER_ACCOUNT = 20
+HTTP_TIMEOUT = 10
+HTTP_MAX_IDLE = 4
+HTTP_TRANSPORT = 'pool'         #'pool': blocking keep-alive connections on the worker threads, 'domoticz': blocking adapter on Domoticz.Connection, no faster than 'pool'
+COMMAND_WORKERS = 2
+COMMAND_DEBOUNCE = 0.5
+COMMAND_DEBOUNCE_MAX_WAIT = 2
+SEARCH_CACHE_SIZE = 100
+SEARCH_CACHE_TTL = 86400
+SEARCH_CACHE_PERSIST = True
+SEARCH_TRACK_LIMIT = 10
+PREWARM_DEVICE = True           #Transfer playback to the selected device while searching, when nothing plays
+PLAN_SEPARATOR = ';'            #searchTxt 'playlist morning; artist coldplay' plays the tracks of both
+PLAN_TRACKS_PER_ITEM = 10
+PLAN_MAX_TRACKS = 100
+WARM_START = True               #Start from the state saved at the last stop, revalidated in the background
+WARM_START_RETRY = 60
+FAVOURITES_INDEX = True         #Index playlists, saved albums and followed artists, played without a search
+FAVOURITES_TTL = 86400
+FAVOURITES_MIN_REFRESH = 3600
+FAVOURITES_MAX_ITEMS = 2000
+FAVOURITES_START_DELAY = 300    #No indexing in the first minutes after a start, one page per heartbeat after that
+FAVOURITES_FUZZY_CUTOFF = 0.8
+LOG_RATE_PER_MINUTE = 30        #Messages per subsystem per minute in the Domoticz log, errors have their own budget
+LOG_JSON_SINK = False           #Also write all messages as json lines to [name]-log.jsonl in the plugin folder
+LOG_JSON_MAX_BYTES = 1048576
+POLL_HEARTBEAT = 10
+POLL_MIN_INTERVAL = 10
+POLL_FAST_INTERVAL = 10
+POLL_FAST_PERIOD = 60
+POLL_IDLE_START = 60
+POLL_TRACK_END_MARGIN = 2
+POLL_MAX_PER_HEARTBEAT = 2
+RATE_LIMIT_PER_SECOND = 5
+RATE_LIMIT_BURST = 10
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+RETRY_MAX_WAIT = 10
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+DEVICE_CACHE_TTL = 3600
+DEVICE_MIN_REFRESH = 60
+METRICS_INTERVAL = 900
+STATISTICSTEXT = 250
+STATISTICSCALLS = 251
+STATISTICSLATENCY = 252
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_JITTER = 120
+TOKEN_RETRY_INTERVAL = 60
+LOCAL_DISCOVERY = False          #Watch Spotify Connect devices on the local network for playback changes
+LOCAL_DISCOVERY_ADDRESS = ('224.0.0.251', 5353)
+LOCAL_DISCOVERY_SERVICE = '_spotify-connect._tcp.local'
+LOCAL_DISCOVERY_TIMEOUT = 2
+LOCAL_DISCOVERY_INTERVAL = 300
+LOCAL_INFO_INTERVAL = 2
+LOCAL_INFO_TIMEOUT = 2
+LOCAL_INFO_FIELDS = ('activeUser', 'status', 'availability', 'groupStatus')
+TOKEN_STORAGE = 'variables'     #'variables': one user variable per field, 'record': one json user variable, 'file': json file in plugin folder
 
 
 #############################################################################
-#                      Domoticz call back functions                         #
+#                      Logging                                              #
 #############################################################################
-class BasePlugin:
-    def __init__(self):
-        self.spotifyToken = {"access_token":"",
-                             "refresh_token":"",
-                             "retrievaldate":""
-                             }
-        self.spotifySearchParam = ["searchTxt"]
-        self.tokenexpired = 3600
-        self.spotArrDevices = {}
-        self.spotifyAccountUrl = "https://accounts.spotify.com/api/token"
-        self.spotifyApiUrl = "https://api.spotify.com/v1"
-        self.heartbeatCounterPoll = 1
-        self.blError = False
-        self.blDebug = False
-        
+class PluginLogger:
+    """Levelled logging per subsystem. Messages are %-formatted only when they are
+    written, each subsystem may write ratePerMinute messages per minute to the Domoticz
+    log (the number dropped is added to the next one), registered secrets and
+    authorization headers are masked and an optional json lines file gets every message."""
+
+    DEBUG = 10
+    INFO = 20
+    ERROR = 40
+    LEVELNAMES = {DEBUG: 'debug', INFO: 'info', ERROR: 'error'}
+    AUTHORIZATION = re.compile(r'(Bearer|Basic) [A-Za-z0-9+/=._~-]+')
+    TOKENFIELD = re.compile(r'''((?:access_token|refresh_token)["']?\s*[:=]\s*["']?)[^"'&,\s}]+''')
+
+    def __init__(self, level=INFO, ratePerMinute=LOG_RATE_PER_MINUTE):
+        self.level = level
+        self.ratePerMinute = ratePerMinute
+        self.budgets = {}
+        self.secrets = {}
+        self.sinkFile = None
+        self.sinkMaxBytes = LOG_JSON_MAX_BYTES
+        self.lock = threading.Lock()
+
+    def setSecret(self, name, secret):
+        #Named, so a renewed token replaces the masked old one
+        secret = str(secret or '')
+        with self.lock:
+            if len(secret) >= 4:
+                self.secrets[name] = secret
+            else:
+                self.secrets.pop(name, None)
+
+    def redact(self, message):
+        message = self.AUTHORIZATION.sub(r'\1 ***', message)
+        message = self.TOKENFIELD.sub(r'\1***', message)
+        for secret in list(self.secrets.values()):
+            if secret in message:
+                message = message.replace(secret, '***')
+        return message
+
+    def openSink(self, fileName, maxBytes=LOG_JSON_MAX_BYTES):
+        self.sinkFile = fileName
+        self.sinkMaxBytes = maxBytes
+
+    def allowed(self, subsystem, level):
+        #Token bucket per subsystem, refilled at ratePerMinute, returns (allowed, dropped before)
+        key = (subsystem, level >= self.ERROR)
+        now = time.time()
+        budget = self.budgets.get(key)
+        if budget is None:
+            budget = self.budgets[key] = [self.ratePerMinute, now, 0]
+        budget[0] = min(self.ratePerMinute, budget[0] + (now - budget[1]) * self.ratePerMinute / 60.0)
+        budget[1] = now
+        if budget[0] < 1:
+            budget[2] += 1
+            return False, 0
+        budget[0] -= 1
+        intDropped, budget[2] = budget[2], 0
+        return True, intDropped
+
+    def debug(self, subsystem, message, *args):
+        if self.level <= self.DEBUG:
+            self.emit(self.DEBUG, subsystem, message, args)
+
+    def info(self, subsystem, message, *args):
+        if self.level <= self.INFO:
+            self.emit(self.INFO, subsystem, message, args)
+
+    def error(self, subsystem, message, *args):
+        self.emit(self.ERROR, subsystem, message, args)
+
+    def emit(self, level, subsystem, message, args):
+        with self.lock:
+            blAllowed, intDropped = self.allowed(subsystem, level)
+        if not blAllowed and not self.sinkFile:
+            return
+
+        message = str(message)
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = '%s %r' % (message, args)
+        message = self.redact(message)
+
+        if self.sinkFile:
+            self.writeSink(level, subsystem, message)
+        if not blAllowed:
+            return
+        if intDropped:
+            message += ' (%s more %s messages suppressed)' % (intDropped, subsystem)
+        if level >= self.ERROR:
+            Domoticz.Error(message)
+        else:
+            Domoticz.Log(message)
 
-    def onStart(self):
+    def writeSink(self, level, subsystem, message):
+        strLine = json.dumps({'time': round(time.time(), 3), 'level': self.LEVELNAMES[level], 'subsystem': subsystem, 'message': message}) + '\n'
+        with self.lock:
+            try:
+                if os.path.exists(self.sinkFile) and os.path.getsize(self.sinkFile) > self.sinkMaxBytes:
+                    os.replace(self.sinkFile, self.sinkFile + '.1')
+                with open(self.sinkFile, 'a') as sinkFile:
+                    sinkFile.write(strLine)
+            except OSError as error:
+                self.sinkFile = None
+                Domoticz.Error('Could not write log file, disabled it: ' + str(error))
 
-        
 
-        if Parameters["Mode6"] == "Debug":
-            self.blDebug = True
+_log = PluginLogger()
 
-        for var in ['Mode1','Mode2','Mode3']:
-            if Parameters[var] == "":
-                Domoticz.Error('No client_id, client_secret and/or code is set in hardware parameters')
-                self.blError = True
+
+#############################################################################
+#                      HTTP connection pool                                 #
+#############################################################################
+class ConnectError(urllib.error.URLError):
+    """No connection could be opened, the request was never sent"""
+    pass
+
+
+class HttpResponse:
+    """Fully read response returned by HttpPool, mimics the urllib response interface"""
+
+    def __init__(self, url, code, reason, headers, body):
+        self.url = url
+        self.code = code
+        self.status = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class HttpPool:
+    """Keeps keep-alive connections per host (scheme, host, port), so requests to
+    accounts.spotify.com, api.spotify.com and domoticz reuse an open TCP/TLS session
+    instead of doing a new handshake on every call."""
+
+    def __init__(self, timeout=HTTP_TIMEOUT, maxIdle=HTTP_MAX_IDLE):
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.idleConnections = {}
+        self.lock = threading.Lock()
+        self.sslContext = ssl.create_default_context()
+
+    def hostKey(self, url):
+        parsedUrl = urllib.parse.urlsplit(url)
+        port = parsedUrl.port or (443 if parsedUrl.scheme == 'https' else 80)
+        return (parsedUrl.scheme, parsedUrl.hostname, port)
+
+    def acquire(self, key, timeout):
+        with self.lock:
+            lstIdle = self.idleConnections.get(key)
+            conn = lstIdle.pop() if lstIdle else None
+        if conn is not None:
+            #The idle connection may have been opened with another timeout
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=self.sslContext)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        return conn, False
+
+    def release(self, key, conn):
+        with self.lock:
+            lstIdle = self.idleConnections.setdefault(key, [])
+            if len(lstIdle) < self.maxIdle:
+                lstIdle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for lstIdle in self.idleConnections.values():
+                for conn in lstIdle:
+                    conn.close()
+            self.idleConnections = {}
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        key = self.hostKey(url)
+        if timeout is None:
+            timeout = self.timeout
+
+        parsedUrl = urllib.parse.urlsplit(url)
+        path = parsedUrl.path or '/'
+        if parsedUrl.query:
+            path += '?' + parsedUrl.query
+
+        dictHeaders = {'Connection': 'keep-alive'}
+        if headers:
+            dictHeaders.update(headers)
+
+        while True:
+            conn, reused = self.acquire(key, timeout)
+            if conn.sock is None:
+                try:
+                    conn.connect()
+                except OSError as err:
+                    conn.close()
+                    raise ConnectError(err)
+            try:
+                conn.request(method, path, body=data, headers=dictHeaders)
+                response = conn.getresponse()
+                body = response.read()
+            except (ConnectionError, http.client.BadStatusLine) as err:
+                conn.close()
+                if reused:
+                    #Server closed an idle keep-alive connection, retry on a fresh one
+                    continue
+                raise urllib.error.URLError(err)
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                raise urllib.error.URLError(err)
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(body))
+
+        return HttpResponse(url, response.status, response.reason, response.msg, body)
+
+
+class TransportRequest:
+    __slots__ = ('method', 'url', 'path', 'headers', 'data', 'sent', 'retried', 'event', 'response', 'error')
+
+    def __init__(self, method, url, path, headers, data):
+        self.method = method
+        self.url = url
+        self.path = path
+        self.headers = headers
+        self.data = data
+        self.sent = False
+        self.retried = False
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class DomoticzTransport(HttpPool):
+    """Blocking HttpPool compatible adapter on the Domoticz.Connection api. The worker
+    thread making a request creates the connection and calls Connect and Send itself,
+    then blocks until Domoticz delivers the response in onMessage on the plugin thread.
+    So there is no concurrency gain over HttpPool: at most COMMAND_WORKERS requests
+    are in flight, one per connection, without pipelining. Requests must never be
+    made from the plugin thread itself, its callbacks could not run while it waits."""
+
+    def __init__(self, timeout=HTTP_TIMEOUT, maxIdle=HTTP_MAX_IDLE):
+        HttpPool.__init__(self, timeout, maxIdle)
+        self.queues = {}
+        self.connections = {}
+        self.connectionKeys = {}
+        self.inFlight = {}
+        self.counter = 0
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        key = self.hostKey(url)
+        if timeout is None:
+            timeout = self.timeout
+
+        parsedUrl = urllib.parse.urlsplit(url)
+        path = parsedUrl.path or '/'
+        if parsedUrl.query:
+            path += '?' + parsedUrl.query
+
+        dictHeaders = {'Host': parsedUrl.netloc, 'Connection': 'keep-alive', 'Accept': '*/*'}
+        if headers:
+            dictHeaders.update(headers)
+        if data is not None or method in ('POST', 'PUT'):
+            dictHeaders['Content-Length'] = str(len(data or b''))
+
+        pending = TransportRequest(method, url, path, dictHeaders, data)
+        with self.lock:
+            self.queues.setdefault(key, collections.deque()).append(pending)
+            self.dispatch(key)
+
+        if not pending.event.wait(timeout):
+            with self.lock:
+                if pending in self.queues.get(key, ()):
+                    self.queues[key].remove(pending)
+            if not pending.sent:
+                raise ConnectError('timed out')
+            raise urllib.error.URLError('timed out')
+        if pending.error is not None:
+            if not pending.sent:
+                raise ConnectError(pending.error)
+            raise urllib.error.URLError(pending.error)
+
+        status = int(pending.response.get('Status', 0))
+        dictResponseHeaders = http.client.HTTPMessage()
+        for name, value in (pending.response.get('Headers') or {}).items():
+            dictResponseHeaders[name] = value
+        body = bytes(pending.response.get('Data') or b'')
+        reason = http.client.responses.get(status, '')
+
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, dictResponseHeaders, io.BytesIO(body))
+
+        return HttpResponse(url, status, reason, dictResponseHeaders, body)
+
+    def dispatch(self, key):
+        #Called with the lock held: hand queued requests to free connections, open more when needed
+        queue = self.queues.get(key)
+        lstConnections = self.connections.setdefault(key, [])
+        for conn in lstConnections:
+            if not queue:
+                return
+            if conn.Connected() and conn.Name not in self.inFlight:
+                self.send(conn, queue.popleft())
+
+        intConnecting = len([conn for conn in lstConnections if conn.Connecting()])
+        while queue and intConnecting < len(queue) and len(lstConnections) < self.maxIdle:
+            self.counter += 1
+            scheme, host, port = key
+            conn = Domoticz.Connection(Name='SpotifyHttp%s' % (self.counter), Transport='TCP/IP', Protocol='HTTPS' if scheme == 'https' else 'HTTP', Address=host, Port=str(port))
+            lstConnections.append(conn)
+            self.connectionKeys[conn.Name] = key
+            conn.Connect()
+            intConnecting += 1
+
+    def send(self, conn, pending):
+        pending.sent = True
+        self.inFlight[conn.Name] = pending
+        dictMessage = {'Verb': pending.method, 'URL': pending.path, 'Headers': pending.headers}
+        if pending.data is not None:
+            dictMessage['Data'] = pending.data
+        conn.Send(dictMessage)
+
+    def remove(self, conn):
+        key = self.connectionKeys.pop(conn.Name, None)
+        lstConnections = self.connections.get(key, [])
+        for other in list(lstConnections):
+            if other.Name == conn.Name:
+                lstConnections.remove(other)
+        return key
+
+    def onConnect(self, Connection, Status, Description):
+        with self.lock:
+            key = self.connectionKeys.get(Connection.Name)
+            if key is None:
+                return
+            if Status != 0:
+                self.remove(Connection)
+                if not self.connections.get(key):
+                    #No connection to this host left, fail the waiting requests now instead of at their timeout
+                    queue = self.queues.get(key) or collections.deque()
+                    while queue:
+                        pending = queue.popleft()
+                        pending.error = Description or 'connection failed'
+                        pending.event.set()
+            self.dispatch(key)
+
+    def onMessage(self, Connection, Data):
+        with self.lock:
+            pending = self.inFlight.pop(Connection.Name, None)
+            if pending is not None:
+                pending.response = Data
+                pending.event.set()
+            key = self.connectionKeys.get(Connection.Name)
+            if key is not None:
+                self.dispatch(key)
+
+    def onDisconnect(self, Connection):
+        with self.lock:
+            pending = self.inFlight.pop(Connection.Name, None)
+            key = self.remove(Connection)
+            if pending is not None and not pending.event.is_set():
+                if not pending.retried and key is not None:
+                    #Server closed an idle keep-alive connection, retry on a fresh one
+                    pending.retried = True
+                    self.queues.setdefault(key, collections.deque()).appendleft(pending)
+                else:
+                    pending.error = 'connection closed'
+                    pending.event.set()
+            if key is not None:
+                self.dispatch(key)
+
+    def close(self):
+        with self.lock:
+            for lstConnections in self.connections.values():
+                for conn in lstConnections:
+                    if conn.Connected() or conn.Connecting():
+                        conn.Disconnect()
+            for pending in list(self.inFlight.values()) + [pending for queue in self.queues.values() for pending in queue]:
+                pending.error = 'transport closed'
+                pending.event.set()
+            self.connections = {}
+            self.connectionKeys = {}
+            self.inFlight = {}
+            self.queues = {}
+
+
+_httpPool = DomoticzTransport() if HTTP_TRANSPORT == 'domoticz' else HttpPool()
+
+
+#############################################################################
+#                      Instrumentation                                      #
+#############################################################################
+class Metrics:
+    """Collects per endpoint latency histograms and status codes plus named counters
+    (retries, token refreshes, cache hits) since the last reset"""
+
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, interval=METRICS_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.endpoints = {}
+            self.counters = collections.Counter()
+
+    def due(self):
+        return self.interval > 0 and time.time() - self.started >= self.interval
+
+    def record(self, endpoint, status, seconds):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = {'calls': 0, 'seconds': 0.0, 'histogram': [0] * (len(self.BUCKETS) + 1), 'status': collections.Counter()}
+                self.endpoints[endpoint] = stats
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['status'][str(status)] += 1
+            intBucket = 0
+            while intBucket < len(self.BUCKETS) and seconds > self.BUCKETS[intBucket]:
+                intBucket += 1
+            stats['histogram'][intBucket] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def percentile(self, stats, fraction):
+        #Upper bound of the histogram bucket holding the requested fraction of calls
+        intTarget = fraction * stats['calls']
+        intSeen = 0
+        for intBucket, intCount in enumerate(stats['histogram']):
+            intSeen += intCount
+            if intSeen >= intTarget and intCount:
+                return self.BUCKETS[intBucket] if intBucket < len(self.BUCKETS) else float('inf')
+        return 0
+
+    def totals(self):
+        with self.lock:
+            intCalls = sum(stats['calls'] for stats in self.endpoints.values())
+            floatSeconds = sum(stats['seconds'] for stats in self.endpoints.values())
+            intErrors = sum(count for stats in self.endpoints.values() for status, count in stats['status'].items() if not status.startswith('2'))
+        return intCalls, intErrors, (floatSeconds / intCalls * 1000) if intCalls else 0
+
+    def summary(self):
+        intCalls, intErrors, floatAvgMs = self.totals()
+        with self.lock:
+            lstParts = ['%s calls, %s failed, avg %.0fms in %.0fs' % (intCalls, intErrors, floatAvgMs, time.time() - self.started)]
+            lstParts += ['%s %s' % (count, name) for name, count in sorted(self.counters.items())]
+            for endpoint, stats in sorted(self.endpoints.items()):
+                strStatus = ','.join('%s:%s' % (status, count) for status, count in sorted(stats['status'].items()))
+                lstParts.append('%s %sx avg %.0fms p95<=%.0fms [%s]' % (endpoint, stats['calls'], stats['seconds'] / stats['calls'] * 1000, self.percentile(stats, 0.95) * 1000, strStatus))
+        return '; '.join(lstParts)
+
+
+_metrics = Metrics()
+
+
+#############################################################################
+#                      Spotify request executor                             #
+#############################################################################
+class CircuitOpenError(urllib.error.URLError):
+    pass
+
+
+def retryAfterSeconds(err):
+    try:
+        return int(err.headers.get('Retry-After', '0') or 0)
+    except (AttributeError, ValueError):
+        return 0
+
+
+def endpointName(method, url):
+    #Ids are replaced, otherwise every playlist, album and artist gets its own statistics
+    lstParts = urllib.parse.urlsplit(url).path.split('/')
+    for x in range(1, len(lstParts)):
+        if lstParts[x - 1] in ('playlists', 'albums', 'artists', 'tracks', 'users') and lstParts[x]:
+            lstParts[x] = '{id}'
+    return method + ' ' + '/'.join(lstParts)
+
+
+class TokenBucket:
+    """Client side rate limit, allows burst requests and then rate requests per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Opens after threshold consecutive failures, calls then fail fast until the
+    cooldown passed. The first call after that decides whether it closes again."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openUntil = 0
+
+    def isOpen(self):
+        return time.time() < self.openUntil
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if not self.isOpen():
+                _log.error('executor', 'Spotify seems to be unavailable, suspending calls for %s seconds', self.cooldown)
+            self.openUntil = time.time() + self.cooldown
+
+    def block(self, seconds):
+        self.openUntil = max(self.openUntil, time.time() + seconds)
+
+
+class RequestExecutor:
+    """Sends all Spotify requests through the connection pool with a client side rate
+    limit, retries on 429 (honouring Retry-After), 5xx and connection errors with
+    exponential back-off and jitter, and a circuit breaker shared by all calls.
+    With retry='connect' (requests that must not run twice, like skipping a track)
+    only 429 and connections that could not be opened are retried: after a 5xx or a
+    timeout spotify may already have executed the request."""
+
+    def __init__(self, pool, bucket, breaker, metrics, maxAttempts=RETRY_MAX_ATTEMPTS):
+        self.pool = pool
+        self.bucket = bucket
+        self.breaker = breaker
+        self.metrics = metrics
+        self.maxAttempts = maxAttempts
+
+    def backoff(self, attempt):
+        time.sleep(RETRY_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def request(self, method, url, headers=None, data=None, retry='all'):
+        endpoint = endpointName(method, url)
+        for attempt in range(1, self.maxAttempts + 1):
+            if self.breaker.isOpen():
+                self.metrics.record(endpoint, 'suspended', 0)
+                raise CircuitOpenError('Spotify calls suspended, too many failures or rate limited')
+            self.bucket.acquire()
+            start = time.time()
+            try:
+                response = self.pool.request(method, url, headers=headers, data=data)
+            except urllib.error.HTTPError as err:
+                self.metrics.record(endpoint, err.code, time.time() - start)
+                if err.code == 429:
+                    retryAfter = retryAfterSeconds(err)
+                    if retryAfter > RETRY_MAX_WAIT or attempt == self.maxAttempts:
+                        self.breaker.block(retryAfter)
+                        raise
+                    self.metrics.count('retries')
+                    time.sleep(retryAfter or RETRY_BACKOFF)
+                    continue
+                if err.code >= 500:
+                    self.breaker.failure()
+                    if attempt == self.maxAttempts or retry == 'connect':
+                        raise
+                    self.metrics.count('retries')
+                    self.backoff(attempt)
+                    continue
+                #Any other status means spotify itself is reachable and answering
+                self.breaker.success()
+                raise
+            except urllib.error.URLError as err:
+                self.metrics.record(endpoint, 'error', time.time() - start)
+                self.breaker.failure()
+                if attempt == self.maxAttempts or (retry == 'connect' and not isinstance(err, ConnectError)):
+                    raise
+                self.metrics.count('retries')
+                self.backoff(attempt)
+                continue
+
+            self.metrics.record(endpoint, response.code, time.time() - start)
+            self.breaker.success()
+            return response
+
+
+_spotifyApi = RequestExecutor(_httpPool, TokenBucket(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST), CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN), _metrics)
+
+
+#############################################################################
+#                      Spotify responses                                    #
+#############################################################################
+def jsonField(data, path, default=None):
+    """Looks up a dotted path ('item.artists.0.name') in parsed json"""
+    for key in path.split('.'):
+        if isinstance(data, dict):
+            data = data.get(key)
+        elif isinstance(data, list) and key.isdigit() and int(key) < len(data):
+            data = data[int(key)]
+        else:
+            return default
+        if data is None:
+            return default
+    return data
+
+
+def parseJson(response):
+    return json.loads(response.read())
+
+
+class Record:
+    """Compact record holding only the FIELDS (attribute -> dotted json path) the
+    plugin uses, so the full response can be dropped right after parsing"""
+
+    __slots__ = ()
+    FIELDS = {}
+
+    def __init__(self, data):
+        for attribute, path in self.FIELDS.items():
+            setattr(self, attribute, jsonField(data, path))
+
+    def snapshot(self):
+        return dict((attribute, getattr(self, attribute)) for attribute in self.FIELDS)
+
+    @classmethod
+    def restore(cls, dictValues):
+        record = cls.__new__(cls)
+        for attribute in cls.FIELDS:
+            setattr(record, attribute, dictValues.get(attribute))
+        return record
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (attribute, getattr(self, attribute)) for attribute in self.FIELDS))
+
+
+class SpotifyDevice(Record):
+    __slots__ = ('id', 'name', 'isActive', 'volumePercent')
+    FIELDS = {'id': 'id', 'name': 'name', 'isActive': 'is_active', 'volumePercent': 'volume_percent'}
+
+
+class SearchItem(Record):
+    __slots__ = ('name', 'uri', 'artist')
+    FIELDS = {'name': 'name', 'uri': 'uri', 'artist': 'artists.0.name'}
+
+
+class TrackUri(Record):
+    __slots__ = ('uri',)
+    FIELDS = {'uri': 'uri'}
+
+
+class PlaylistTrackUri(Record):
+    __slots__ = ('uri',)
+    FIELDS = {'uri': 'track.uri'}
+
+
+class SavedAlbum(Record):
+    __slots__ = ('name', 'uri', 'artist')
+    FIELDS = {'name': 'album.name', 'uri': 'album.uri', 'artist': 'album.artists.0.name'}
+
+
+class PlaybackState(Record):
+    __slots__ = ('isPlaying', 'deviceName', 'volumePercent', 'shuffle', 'repeat', 'progressMs', 'durationMs', 'itemName', 'artist')
+    FIELDS = {'isPlaying': 'is_playing', 'deviceName': 'device.name', 'volumePercent': 'device.volume_percent',
+              'shuffle': 'shuffle_state', 'repeat': 'repeat_state', 'progressMs': 'progress_ms',
+              'durationMs': 'item.duration_ms', 'itemName': 'item.name', 'artist': 'item.artists.0.name'}
+
+    def nowPlaying(self):
+        if not self.itemName:
+            return ''
+        if self.artist:
+            return '%s - %s' % (self.artist, self.itemName)
+        return self.itemName
+
+    def progressPercent(self):
+        if self.progressMs is None or not self.durationMs:
+            return None
+        return min(100, 100 * self.progressMs // self.durationMs)
+
+
+#############################################################################
+#                      Caching                                              #
+#############################################################################
+class LruCache:
+    """Size bounded least recently used cache whose entries expire after ttl seconds.
+    Keys are tuples of strings so the cache can be persisted as json."""
+
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        #Workers and plan threads save at the same time, they share the temp file
+        self.saveLock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
                 return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def contains(self, key):
+        #Unlike get, does not count as a hit or miss nor refresh the entry
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[0] >= time.time()
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def save(self, fileName):
+        with self.saveLock:
+            with self.lock:
+                lstEntries = [[list(key), expires, value] for key, (expires, value) in self.entries.items()]
+            try:
+                with open(fileName + '.tmp', 'w') as cacheFile:
+                    json.dump(lstEntries, cacheFile)
+                os.replace(fileName + '.tmp', fileName)
+            except (OSError, ValueError) as error:
+                _log.error('cache', 'Could not save cache to %s: %s', fileName, error)
 
-        if not self.getUserVar():
-            self.blError = True
+    def load(self, fileName):
+        try:
+            with open(fileName) as cacheFile:
+                lstEntries = json.load(cacheFile)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            _log.error('cache', 'Could not load cache from %s: %s', fileName, error)
+            return
+
+        now = time.time()
+        with self.lock:
+            for key, expires, value in lstEntries:
+                if expires > now:
+                    self.entries[tuple(key)] = (expires, value)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+
+def normaliseName(name):
+    return ' '.join(''.join(char if char.isalnum() else ' ' for char in name.lower()).split())
+
+
+class FavouritesIndex:
+    """Local index of the playlists, saved albums and followed artists of an account.
+    Entries are [name, uri, artist] lists per type, looked up by exact, prefix and
+    fuzzy name match. The index is persisted as json and counts as fresh for ttl seconds."""
+
+    def __init__(self, ttl=FAVOURITES_TTL, minRefresh=FAVOURITES_MIN_REFRESH):
+        self.ttl = ttl
+        self.minRefresh = minRefresh
+        self.entries = {}
+        self.names = {}
+        self.updated = 0
+        self.lastRefresh = 0
+        self.lock = threading.Lock()
+
+    def isFresh(self):
+        return time.time() - self.updated < self.ttl
+
+    def mayRefresh(self):
+        return time.time() - self.lastRefresh >= self.minRefresh
+
+    def refreshStarted(self):
+        self.lastRefresh = time.time()
+
+    def replace(self, dictEntries, updated=None):
+        dictNames = {}
+        for type, lstEntries in dictEntries.items():
+            dictType = {}
+            for entry in lstEntries:
+                dictType.setdefault(normaliseName(entry[0]), entry)
+            dictNames[type] = (dictType, sorted(dictType))
+        with self.lock:
+            self.entries = dictEntries
+            self.names = dictNames
+            self.updated = time.time() if updated is None else updated
+
+    def lookup(self, type, query):
+        with self.lock:
+            index = self.names.get(type)
+        strQuery = normaliseName(query)
+        if not index or not strQuery:
             return None
-            
 
-        for key, value in self.spotifyToken.items():
-            if value == '':
-                Domoticz.Log("Not all spotify token variables are available, let's get it")
-                if not self.spotAuthoriseCode():
-                    self.blError = True
-                    return None
-                break
+        dictType, lstSorted = index
+        entry = dictType.get(strQuery)
+        if entry is None:
+            #Only whole words, 'ten' finds 'ten years' but not 'tenacious d'
+            strPrefix = strQuery + ' '
+            position = bisect.bisect_left(lstSorted, strPrefix)
+            if position < len(lstSorted) and lstSorted[position].startswith(strPrefix):
+                entry = dictType[lstSorted[position]]
+        if entry is None:
+            lstClose = difflib.get_close_matches(strQuery, lstSorted, 1, FAVOURITES_FUZZY_CUTOFF)
+            if lstClose:
+                entry = dictType[lstClose[0]]
+        return entry
+
+    def count(self):
+        with self.lock:
+            return sum(len(lstEntries) for lstEntries in self.entries.values())
+
+    def save(self, fileName):
+        with self.lock:
+            dictData = {'updated': self.updated, 'entries': self.entries}
+        try:
+            with open(fileName + '.tmp', 'w') as indexFile:
+                json.dump(dictData, indexFile, separators=(',', ':'))
+            os.replace(fileName + '.tmp', fileName)
+        except (OSError, ValueError) as error:
+            _log.error('cache', 'Could not save favourites to %s: %s', fileName, error)
+
+    def load(self, fileName):
+        try:
+            with open(fileName) as indexFile:
+                dictData = json.load(indexFile)
+            self.replace(dictData['entries'], dictData['updated'])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            _log.error('cache', 'Could not load favourites from %s: %s', fileName, error)
+
+
+class StateSnapshot:
+    """Json file in the plugin folder with the state needed to start without waiting
+    on Domoticz or Spotify. Only written when its content changed."""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.saved = None
+
+    def load(self):
+        try:
+            with open(self.fileName) as snapshotFile:
+                self.saved = snapshotFile.read()
+            return json.loads(self.saved)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            _log.error('cache', 'Could not load warm start state from %s: %s', self.fileName, error)
+            return None
+
+    def save(self, dictSnapshot):
+        strSnapshot = json.dumps(dictSnapshot, sort_keys=True)
+        if strSnapshot == self.saved:
+            return
+        try:
+            with open(self.fileName + '.tmp', 'w') as snapshotFile:
+                snapshotFile.write(strSnapshot)
+            os.replace(self.fileName + '.tmp', self.fileName)
+            self.saved = strSnapshot
+        except OSError as error:
+            _log.error('cache', 'Could not save warm start state to %s: %s', self.fileName, error)
+
+
+class CreatedUnits:
+    """Json file in the plugin folder with the units the plugin ever created, so a
+    device the user deleted is not created again at the next start."""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.units = set()
+        self.saved = set()
+
+    def load(self):
+        try:
+            with open(self.fileName) as unitsFile:
+                self.units = set(json.load(unitsFile))
+        except FileNotFoundError:
+            self.units = set()
+        except (OSError, ValueError) as error:
+            _log.error('devices', 'Could not load created units from %s: %s', self.fileName, error)
+            self.units = set()
+        if not Devices:
+            #New hardware (or all devices removed), start over
+            self.units = set()
+        self.saved = set(self.units)
+
+    def create(self, unit, **options):
+        if unit in Devices:
+            #Also devices created before the file existed
+            self.units.add(unit)
+            return
+        if unit in self.units:
+            _log.debug('devices', 'Unit %s was deleted, not creating it again', unit)
+            return
+        Domoticz.Device(Unit=unit, **options).Create()
+        self.units.add(unit)
+
+    def save(self):
+        if self.units == self.saved:
+            return
+        try:
+            with open(self.fileName + '.tmp', 'w') as unitsFile:
+                json.dump(sorted(self.units), unitsFile)
+            os.replace(self.fileName + '.tmp', self.fileName)
+            self.saved = set(self.units)
+        except OSError as error:
+            _log.error('devices', 'Could not save created units to %s: %s', self.fileName, error)
+
+
+#############################################################################
+#                      Command worker queue                                 #
+#############################################################################
+class CommandQueue:
+    """Executes jobs on background worker threads so the Domoticz plugin thread never
+    waits on Spotify. Jobs sharing a key run one at a time in submission order; a job
+    still waiting in the queue is replaced when a newer job with the same key arrives.
+    Debounced jobs wait until their key stayed quiet for a while, so a burst becomes
+    one job. With zero workers (or before start) jobs run inline on the calling thread."""
+
+    def __init__(self, workers=COMMAND_WORKERS):
+        self.workers = workers
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.busyKeys = set()
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        with self.condition:
+            if self.running or self.workers < 1:
+                return
+            self.running = True
+        for x in range(self.workers):
+            thread = threading.Thread(name='SpotifyWorker%s' % x, target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=HTTP_TIMEOUT):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def waitIdle(self, timeout):
+        end = time.time() + timeout
+        with self.condition:
+            while self.pending or self.busyKeys:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def put(self, key, function, *args):
+        self.schedule(key, function, args, 0, 0)
+
+    def debounce(self, key, delay, function, *args):
+        with self.condition:
+            #Wait for the burst to settle, but never longer than the max wait after its first job
+            previous = self.pending.get(key)
+            now = time.time()
+            deadline = previous[3] if previous and previous[3] else now + COMMAND_DEBOUNCE_MAX_WAIT
+            self.schedule(key, function, args, min(now + delay, deadline), deadline)
+
+    def schedule(self, key, function, args, due, deadline):
+        with self.condition:
+            if self.running:
+                if key in self.pending:
+                    _log.debug('queue', 'Queued job %s superseded by a newer one', key)
+                    _metrics.count('commands coalesced')
+                self.pending[key] = (function, args, due, deadline)
+                self.condition.notify()
+                return
+        self.execute(key, function, args)
+
+    def next(self):
+        now = time.time()
+        for key, (function, args, due, deadline) in self.pending.items():
+            if key not in self.busyKeys and due <= now:
+                del self.pending[key]
+                self.busyKeys.add(key)
+                return key, function, args
+        return None
+
+    def waitTime(self):
+        #Jobs of a busy key wait for its notify_all instead of their due time
+        lstDue = [job[2] for key, job in self.pending.items() if job[2] and key not in self.busyKeys]
+        if not lstDue:
+            return None
+        return max(0, min(lstDue) - time.time())
+
+    def run(self):
+        while True:
+            with self.condition:
+                job = None
+                while self.running:
+                    job = self.next()
+                    if job:
+                        break
+                    self.condition.wait(self.waitTime())
+                if not job:
+                    return
+
+            key, function, args = job
+            try:
+                self.execute(key, function, args)
+            finally:
+                with self.condition:
+                    self.busyKeys.discard(key)
+                    self.condition.notify_all()
+
+    def execute(self, key, function, args):
+        try:
+            function(*args)
+        except Exception as error:
+            _log.error('queue', 'Error executing %s: %s', key, error)
 
-        self.checkDevices()
 
-        Domoticz.Heartbeat(30)
+def runConcurrently(lstCalls):
+    """Runs (function, args...) tuples on threads of their own and returns their results
+    in order, with the exception in place of the result of a call that raised"""
+    lstResults = [None] * len(lstCalls)
 
+    def run(index, function, args):
+        try:
+            lstResults[index] = function(*args)
+        except Exception as error:
+            lstResults[index] = error
+
+    lstThreads = []
+    for index, call in enumerate(lstCalls):
+        thread = threading.Thread(name='SpotifyConcurrent%s' % index, target=run, args=(index, call[0], call[1:]))
+        thread.daemon = True
+        thread.start()
+        lstThreads.append(thread)
+    for thread in lstThreads:
+        thread.join()
+    return lstResults
+
+
+#############################################################################
+#                      Domoticz user variables                              #
+#############################################################################
+class UserVariableStore:
+    """Local copy of the Domoticz user variables indexed by name. The full table is
+    only downloaded at start (or when a variable is unknown), afterwards a variable
+    is refreshed on its own using its idx."""
+
+    def __init__(self):
+        self.variables = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        variables = DomoticzAPI({'type':'command','param':'getuservariables'})
+        if not variables:
+            return False
+
+        dictVariables = {}
+        for item in variables.get("result", []):
+            dictVariables[item["Name"]] = item
+        with self.lock:
+            self.variables = dictVariables
+        return True
+
+    def get(self, name):
+        with self.lock:
+            return self.variables.get(name)
+
+    def set(self, name, value):
+        with self.lock:
+            if name in self.variables:
+                self.variables[name]['Value'] = value
+
+    def fetch(self, name):
+        item = self.get(name)
+        if item is None:
+            self.refresh()
+            return self.get(name)
+
+        try:
+            variable = DomoticzAPI({'type':'command','param':'getuservariable','idx':item['idx']})
+            result = variable["result"][0]
+            if result["Name"] != name:
+                raise KeyError(name)
+        except Exception as error:
+            #Variable was removed or renumbered, fall back to reading all variables
+            _log.debug('variables', 'Reading user variable %s by idx failed (%s), reloading all variables', name, error)
+            self.refresh()
+            return self.get(name)
+
+        with self.lock:
+            self.variables[name] = result
+        return result
+
+
+class TokenStore:
+    """Persists the spotify token record, writing only the fields that changed since
+    the last save. The record is kept either as one user variable per field, as one
+    json user variable or as a json file in the plugin folder."""
+
+    def __init__(self, storage, name, userVariables, fileName):
+        self.storage = storage
+        self.name = name
+        self.userVariables = userVariables
+        self.fileName = fileName
+        self.saved = {}
+        self.lock = threading.Lock()
+
+    def variableFields(self):
+        if self.storage == 'variables':
+            return ['access_token', 'refresh_token', 'retrievaldate']
+        elif self.storage == 'record':
+            return ['spotifyToken']
+        return []
+
+    def variableName(self, field):
+        return self.name + '-' + field
+
+    def legacyRecord(self):
+        dictToken = {}
+        for field in ['access_token', 'refresh_token', 'retrievaldate']:
+            result = self.userVariables.get(self.variableName(field))
+            if result is not None:
+                dictToken[field] = result['Value']
+        return dictToken
+
+    def load(self, token):
+        dictToken = {}
+        if self.storage == 'variables':
+            dictToken = self.legacyRecord()
+        else:
+            try:
+                if self.storage == 'record':
+                    result = self.userVariables.get(self.variableName('spotifyToken'))
+                    strRecord = result['Value'] if result else ''
+                else:
+                    with open(self.fileName) as tokenFile:
+                        strRecord = tokenFile.read()
+                dictToken = json.loads(strRecord) if strRecord else {}
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as error:
+                _log.error('token', 'Could not read stored spotify token: %s', error)
+
+            if not dictToken:
+                #Migrate tokens stored by earlier versions in separate user variables
+                dictToken = self.legacyRecord()
+
+        for field in token:
+            if field in dictToken:
+                token[field] = str(dictToken[field])
+        with self.lock:
+            self.saved = dict((field, str(dictToken.get(field, ''))) for field in token)
+
+    def save(self, token):
+        with self.lock:
+            dictToken = dict((field, str(value)) for field, value in token.items())
+            lstChanged = [field for field in dictToken if self.saved.get(field) != dictToken[field]]
+            if not lstChanged:
+                return
+
+            if self.storage == 'variables':
+                for field in lstChanged:
+                    DomoticzAPI({"type":"command","param":"updateuservariable","vname":self.variableName(field),"vtype":"2","vvalue":dictToken[field]})
+                    self.userVariables.set(self.variableName(field), dictToken[field])
+                    self.saved[field] = dictToken[field]
+                return
+
+            strRecord = json.dumps(dictToken)
+            if self.storage == 'record':
+                DomoticzAPI({"type":"command","param":"updateuservariable","vname":self.variableName('spotifyToken'),"vtype":"2","vvalue":strRecord})
+                self.userVariables.set(self.variableName('spotifyToken'), strRecord)
+            else:
+                with open(self.fileName + '.tmp', 'w') as tokenFile:
+                    tokenFile.write(strRecord)
+                os.replace(self.fileName + '.tmp', self.fileName)
+            self.saved = dictToken
+
+
+#############################################################################
+#                      Spotify access token                                 #
+#############################################################################
+def tokenRetrievalDate(token):
+    try:
+        return float(token['retrievaldate'])
+    except ValueError:
+        return 0
+
+
+class TokenManager:
+    """Keeps the access token in the shared token dict valid. A refresh is scheduled
+    ahead of expires_in with some jitter, and concurrent refreshes of the same token
+    are collapsed into one call of refreshFunction. After a failed refresh nobody
+    tries again for TOKEN_RETRY_INTERVAL seconds, callers that waited on it included."""
+
+    def __init__(self, token, refreshFunction, margin=TOKEN_REFRESH_MARGIN, jitter=TOKEN_REFRESH_JITTER):
+        self.token = token
+        self.refreshFunction = refreshFunction
+        self.margin = margin
+        self.jitter = jitter
+        self.expiresIn = 3600
+        self.lock = threading.Lock()
+        self.refreshAt = 0
+        self.retryAt = 0
+        self.scheduleRefresh()
+
+    def retrievalDate(self):
+        return tokenRetrievalDate(self.token)
+
+    def scheduleRefresh(self):
+        self.refreshAt = self.retrievalDate() + self.expiresIn - self.margin - random.uniform(0, self.jitter)
+
+    def tokenUpdated(self, response):
+        if 'expires_in' in response:
+            self.expiresIn = int(response['expires_in'])
+        self.scheduleRefresh()
+
+    def needsRefresh(self):
+        return time.time() >= self.refreshAt
+
+    def isExpired(self):
+        return time.time() >= self.retrievalDate() + self.expiresIn
+
+    def refresh(self, staleAccessToken):
+        with self.lock:
+            if self.token['access_token'] != staleAccessToken:
+                #Another thread already renewed the token while we were waiting
+                return
+            if time.time() < self.retryAt:
+                #The last attempt failed a moment ago, maybe while we were waiting on it
+                return
+            _log.info('token', 'Token (almost) expired, getting new one using refresh_token')
+            _metrics.count('token refreshes')
+            try:
+                self.refreshFunction()
+            finally:
+                if self.token['access_token'] == staleAccessToken:
+                    self.refreshAt = self.retryAt = time.time() + TOKEN_RETRY_INTERVAL
+
+    def bearerHeader(self):
+        accessToken = self.token['access_token']
+        if self.isExpired() and self.needsRefresh():
+            self.refresh(accessToken)
+            accessToken = self.token['access_token']
+        return {"Authorization": "Bearer " + accessToken}
+
+
+#############################################################################
+#                      Spotify connect devices                              #
+#############################################################################
+class DeviceRegistry:
+    """Maps the levels of the devices selector switch to spotify device ids and the
+    level names back to levels. The device list is considered fresh for ttl seconds
+    and is never fetched more often than once per minRefresh seconds."""
+
+    def __init__(self, ttl=DEVICE_CACHE_TTL, minRefresh=DEVICE_MIN_REFRESH):
+        self.ttl = ttl
+        self.minRefresh = minRefresh
+        self.levelIds = {}
+        self.nameLevels = {}
+        self.indexedNames = None
+        self.updated = 0
+        self.lastRefresh = 0
+
+    def isFresh(self):
+        return time.time() - self.updated < self.ttl
+
+    def mayRefresh(self):
+        return time.time() - self.lastRefresh >= self.minRefresh
+
+    def refreshStarted(self):
+        self.lastRefresh = time.time()
+
+    def snapshot(self):
+        return {'levelIds': self.levelIds, 'nameLevels': self.nameLevels, 'indexedNames': self.indexedNames, 'updated': self.updated}
+
+    def restore(self, dictSnapshot):
+        self.levelIds = dict(dictSnapshot.get('levelIds') or {})
+        self.nameLevels = dict(dictSnapshot.get('nameLevels') or {})
+        self.indexedNames = dictSnapshot.get('indexedNames')
+        self.updated = dictSnapshot.get('updated') or 0
+
+    def indexNames(self, strSelectorNames):
+        dictNameLevels = {}
+        for intLevel, name in enumerate(strSelectorNames.split('|')):
+            dictNameLevels.setdefault(name, str(intLevel * 10))
+        self.nameLevels = dictNameLevels
+        self.indexedNames = strSelectorNames
+
+    def levelForName(self, name, strSelectorNames):
+        if strSelectorNames != self.indexedNames:
+            #Level names were changed, e.g. renamed in the domoticz ui
+            self.indexNames(strSelectorNames)
+        return self.nameLevels.get(name)
+
+    def deviceId(self, level):
+        return self.levelIds.get(level)
+
+    def selectorOptions(self, strSelectorNames):
+        return {"LevelActions": '|' * strSelectorNames.count('|'),
+                "LevelNames": strSelectorNames,
+                "LevelOffHidden": "false",
+                "SelectorStyle": "1"}
+
+    def update(self, strSelectorNames, lstDevices):
+        self.indexNames(strSelectorNames)
+        dictLevelIds = {}
+        intCounter = (strSelectorNames.count("|") + 1) * 10
+        for device in lstDevices:
+            level = self.nameLevels.get(device.name)
+            if level is None:
+                strSelectorNames += '|' + device.name
+                level = str(intCounter)
+                self.nameLevels[device.name] = level
+                intCounter += 10
+            dictLevelIds[level] = device.id
+
+        self.indexedNames = strSelectorNames
+        self.levelIds = dictLevelIds
+        self.updated = time.time()
+        return self.selectorOptions(strSelectorNames)
+
+
+#############################################################################
+#                      Playback state polling                               #
+#############################################################################
+class PlaybackPoller:
+    """Schedules polls of /me/player. Polls quickly right after a command, at the end
+    of the current track while playing, and backs off exponentially while idle. No
+    interval exceeds maxInterval (seconds); a maxInterval of 0 disables polling."""
+
+    def __init__(self, maxInterval):
+        self.maxInterval = maxInterval
+        self.nextPoll = 0
+        self.idleInterval = POLL_IDLE_START
+        self.fastUntil = 0
+        self.blockedUntil = 0
+
+    def due(self):
+        return self.maxInterval > 0 and time.time() >= self.nextPoll
+
+    def dispatched(self):
+        #Guard against queueing a second poll while this one is in flight
+        self.nextPoll = time.time() + self.maxInterval
+
+    def schedule(self, interval):
+        now = time.time()
+        if now < self.fastUntil:
+            interval = min(interval, POLL_FAST_INTERVAL)
+        interval = max(min(interval, self.maxInterval), POLL_MIN_INTERVAL)
+        self.nextPoll = max(now + interval, self.blockedUntil)
+
+    def commandSent(self):
+        self.fastUntil = time.time() + POLL_FAST_PERIOD
+        self.idleInterval = POLL_IDLE_START
+        self.nextPoll = max(min(self.nextPoll, time.time() + POLL_FAST_INTERVAL), self.blockedUntil)
+
+    def playing(self, progressMs, durationMs):
+        self.idleInterval = POLL_IDLE_START
+        interval = self.maxInterval
+        if progressMs is not None and durationMs:
+            interval = (durationMs - progressMs) / 1000.0 + POLL_TRACK_END_MARGIN
+        self.schedule(interval)
+
+    def idle(self):
+        self.schedule(self.idleInterval)
+        self.idleInterval = min(self.idleInterval * 2, max(self.maxInterval, POLL_IDLE_START))
+
+    def rateLimited(self, retryAfter):
+        self.blockedUntil = time.time() + retryAfter
+        self.nextPoll = max(self.nextPoll, self.blockedUntil)
+
+    def changed(self):
+        #Playback changed outside of domoticz, returns whether a poll may go out now
+        if self.maxInterval <= 0:
+            return False
+        if time.time() < self.blockedUntil:
+            self.nextPoll = self.blockedUntil
+            return False
+        self.dispatched()
+        return True
+
+
+#############################################################################
+#                      Local Spotify Connect discovery                      #
+#############################################################################
+def dnsEncodeName(name):
+    return b''.join(bytes([len(label)]) + label for label in [label.encode('utf-8') for label in name.split('.') if label]) + b'\0'
+
+
+def dnsReadName(data, offset):
+    """Reads a possibly compressed dns name, returns the name and the offset after it"""
+    labels = []
+    end = None
+    for x in range(128):
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode('utf-8', 'replace'))
+        offset += length
+    return '.'.join(labels), end if end is not None else offset
+
+
+class MdnsBrowser:
+    """Minimal mDNS (RFC 6762) browser: sends one PTR query for a service type and
+    collects the PTR, SRV, TXT and A records of the answers. Queries are sent from
+    an ephemeral port, so responders answer with unicast to this socket."""
+
+    def __init__(self, address=LOCAL_DISCOVERY_ADDRESS, timeout=LOCAL_DISCOVERY_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+
+    def query(self, service):
+        header = struct.pack('!HHHHHH', 0, 0, 1, 0, 0, 0)
+        #Class IN with the unicast response bit set
+        return header + dnsEncodeName(service) + struct.pack('!HH', 12, 0x8001)
+
+    def parse(self, data, records):
+        intQuestions, intAnswers, intAuthority, intAdditional = struct.unpack('!4H', data[4:12])
+        offset = 12
+        for x in range(intQuestions):
+            name, offset = dnsReadName(data, offset)
+            offset += 4
+        for x in range(intAnswers + intAuthority + intAdditional):
+            name, offset = dnsReadName(data, offset)
+            rrType, rrClass, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            rdata = data[offset:offset + length]
+            if rrType == 12:
+                records['ptr'].setdefault(name.lower(), set()).add(dnsReadName(data, offset)[0])
+            elif rrType == 33:
+                port = struct.unpack('!H', rdata[4:6])[0]
+                records['srv'][name.lower()] = (dnsReadName(data, offset + 6)[0], port)
+            elif rrType == 16:
+                dictTxt = {}
+                pos = 0
+                while pos < length:
+                    entry = rdata[pos + 1:pos + 1 + rdata[pos]].decode('utf-8', 'replace')
+                    pos += 1 + rdata[pos]
+                    key, _, value = entry.partition('=')
+                    dictTxt[key] = value
+                records['txt'][name.lower()] = dictTxt
+            elif rrType == 1 and length == 4:
+                records['a'][name.lower()] = socket.inet_ntoa(rdata)
+            offset += length
+
+    def browse(self, service):
+        """Returns a dict instance name -> {'name', 'address', 'port', 'txt'}"""
+        records = {'ptr': {}, 'srv': {}, 'txt': {}, 'a': {}, 'source': {}}
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+            sock.bind(('', 0))
+            sock.sendto(self.query(service), self.address)
+            end = time.time() + self.timeout
+            while True:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, source = sock.recvfrom(9000)
+                except socket.timeout:
+                    break
+                try:
+                    before = set(records['srv'])
+                    self.parse(data, records)
+                    for name in set(records['srv']) - before:
+                        records['source'][name] = source[0]
+                except (IndexError, struct.error):
+                    _log.debug('local', 'Ignoring malformed mDNS packet from %s', source[0])
+        finally:
+            sock.close()
+
+        dictServices = {}
+        for instance in records['ptr'].get(service.lower().rstrip('.'), ()):
+            srv = records['srv'].get(instance.lower())
+            if srv is None:
+                continue
+            host, port = srv
+            #The source is missing when the packet holding the srv record failed to parse
+            address = records['a'].get(host.lower()) or records['source'].get(instance.lower())
+            if address is None:
+                continue
+            dictServices[instance] = {'name': instance.split('.')[0],
+                                      'address': address,
+                                      'port': port,
+                                      'txt': records['txt'].get(instance.lower(), {})}
+        return dictServices
+
+
+class ConnectListener:
+    """Watches the Spotify Connect devices on the local network. Devices are discovered
+    with mDNS every discoveryInterval seconds and their getInfo endpoint is checked
+    every infoInterval seconds; onChange is called once per round in which a device
+    changed its activity fields, appeared or disappeared."""
+
+    def __init__(self, onChange, browser=None, discoveryInterval=LOCAL_DISCOVERY_INTERVAL, infoInterval=LOCAL_INFO_INTERVAL):
+        self.onChange = onChange
+        self.browser = browser or MdnsBrowser()
+        self.discoveryInterval = discoveryInterval
+        self.infoInterval = infoInterval
+        self.devices = {}
+        self.states = None
+        self.nextDiscovery = 0
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(name='SpotifyConnectListener', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread:
+            self.thread.join(HTTP_TIMEOUT)
+            self.thread = None
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.check()
+            except Exception as error:
+                _log.error('local', 'Local Spotify Connect listener: %s', error)
+            self.stopEvent.wait(self.infoInterval)
+
+    def discover(self):
+        self.devices = self.browser.browse(LOCAL_DISCOVERY_SERVICE)
+        self.nextDiscovery = time.time() + self.discoveryInterval
+        _log.debug('local', 'Found %s Spotify Connect devices on the local network', len(self.devices))
+
+    def getInfo(self, device):
+        path = device['txt'].get('CPath') or '/'
+        url = 'http://%s:%s%s?action=getInfo' % (device['address'], device['port'], path)
+        response = _httpPool.request('GET', url, timeout=LOCAL_INFO_TIMEOUT)
+        return json.loads(response.read().decode('utf-8'))
+
+    def check(self):
+        if time.time() >= self.nextDiscovery:
+            self.discover()
+
+        dictStates = {}
+        for instance, device in self.devices.items():
+            try:
+                info = self.getInfo(device)
+                dictStates[instance] = tuple(info.get(field) for field in LOCAL_INFO_FIELDS)
+            except (urllib.error.URLError, ValueError) as err:
+                _log.debug('local', 'No getInfo from %s: %s', device['name'], err)
+
+        #The first round only records the states
+        blChanged = self.states is not None and dictStates != self.states
+        self.states = dictStates
+        if blChanged:
+            _metrics.count('local changes')
+            self.onChange()
+        return blChanged
+
+
+#############################################################################
+#                      Spotify accounts                                     #
+#############################################################################
+def parseAccounts(strAccounts):
+    """Parses the extra accounts hardware parameter 'name:code,name:code'"""
+    lstAccounts = []
+    for strAccount in strAccounts.split(','):
+        if strAccount.strip() == '':
+            continue
+        name, _, code = strAccount.partition(':')
+        lstAccounts.append((name.strip().replace(' ', '_'), code.strip()))
+    return lstAccounts
+
+
+class SpotifyAccount:
+    """One spotify account with its own token record, user variables and devices
+    selector. The first account uses the hardware parameters and the original
+    variable names, extra accounts prefix their variables and get their own block
+    of UNITS_PER_ACCOUNT units."""
+
+    def __init__(self, plugin, index, varPrefix, name, code):
+        self.plugin = plugin
+        self.index = index
+        self.varPrefix = varPrefix
+        self.name = name
+        self.code = code
+        self.unitBase = index * UNITS_PER_ACCOUNT
+        self.spotifyToken = {"access_token":"",
+                             "refresh_token":"",
+                             "retrievaldate":""
+                             }
+        self.spotifySearchParam = ["searchTxt"]
+        self.tokenManager = TokenManager(self.spotifyToken, self.spotGetRefreshToken)
+        self.tokenStore = TokenStore(TOKEN_STORAGE, varPrefix, plugin.userVariables, os.path.join(Parameters["HomeFolder"], varPrefix + '-token.json'))
+        self.deviceRegistry = DeviceRegistry()
+        self.favourites = FavouritesIndex()
+        self.favouritesFile = os.path.join(Parameters["HomeFolder"], varPrefix + '-favourites.json')
+        self.favouritesRefresh = None
+        self.poller = PlaybackPoller(0)
+        self.registerSecrets()
+        self.lastState = None
+        self.savedState = None
+        self.blError = False
+
+    def unit(self, offset):
+        return self.unitBase + offset
+
+    def deviceName(self, name):
+        return name if self.index == 0 else name + ' ' + self.name
 
     def checkDevices(self):
-        Domoticz.Log("Checking if devices exis")
+        _log.info('devices', "Checking if devices exis")
         
-        if SPOTIFYDEVICES not in Devices:
-            Domoticz.Log("Spotify devices selector does not exist, creating device")
+        if self.unit(SPOTIFYDEVICES) not in Devices:
+            _log.info('devices', "Spotify devices selector does not exist, creating device")
 
             strSelectorNames = 'Off'
-            dictOptions = self.buildDeviceSelector(strSelectorNames)
+            dictOptions = self.buildDeviceSelector(strSelectorNames) or self.deviceRegistry.selectorOptions(strSelectorNames)
             
-            Domoticz.Device(Name="devices", Unit=SPOTIFYDEVICES, Used=1, TypeName="Selector Switch", Switchtype=18, Options = dictOptions, Image=8).Create()
-        else:
-            self.updateDeviceSelector()
-
-    def updateDeviceSelector(self):
-        if self.blDebug:
-            Domoticz.Log("Updating spotify devices selector")
-        strSelectorNames = Devices[SPOTIFYDEVICES].Options['LevelNames']
+            Domoticz.Device(Name=self.deviceName("devices"), Unit=self.unit(SPOTIFYDEVICES), Used=1, TypeName="Selector Switch", Switchtype=18, Options = dictOptions, Image=8).Create()
+        elif not self.deviceRegistry.levelIds:
+            #A device map restored from the warm start state is refreshed in the background
+            self.updateDeviceSelector(True)
+
+        #The other devices are optional, once deleted they stay deleted
+        createdUnits = self.plugin.createdUnits
+        createdUnits.create(self.unit(NOWPLAYING), Name=self.deviceName("now playing"), Used=1, TypeName="Text")
+        createdUnits.create(self.unit(VOLUME), Name=self.deviceName("volume"), Used=1, Type=244, Subtype=73, Switchtype=7, Image=8)
+        createdUnits.create(self.unit(SHUFFLE), Name=self.deviceName("shuffle"), Used=1, TypeName="Switch", Image=8)
+        dictOptions = {"LevelActions": "||", "LevelNames": "Off|Track|Context", "LevelOffHidden": "false", "SelectorStyle": "0"}
+        createdUnits.create(self.unit(REPEAT), Name=self.deviceName("repeat"), Used=1, TypeName="Selector Switch", Switchtype=18, Options=dictOptions, Image=8)
+        createdUnits.create(self.unit(PROGRESS), Name=self.deviceName("progress"), Used=1, TypeName="Percentage")
+        createdUnits.create(self.unit(NEXT), Name=self.deviceName("next"), Used=1, TypeName="Switch", Switchtype=9, Image=8)
+        createdUnits.create(self.unit(PREVIOUS), Name=self.deviceName("previous"), Used=1, TypeName="Switch", Switchtype=9, Image=8)
+        createdUnits.create(self.unit(SEEK), Name=self.deviceName("seek"), Used=1, Type=244, Subtype=73, Switchtype=7, Image=8)
+
+    def updateDeviceSelector(self, force=False):
+        if self.deviceRegistry.isFresh() and not force:
+            return
+        if not self.deviceRegistry.mayRefresh():
+            _log.debug('devices', 'Spotify devices were refreshed less than %s seconds ago, skipping', DEVICE_MIN_REFRESH)
+            return
+
+        _log.debug('devices', 'Updating spotify devices selector')
+        selector = Devices[self.unit(SPOTIFYDEVICES)]
+        strSelectorNames = selector.Options['LevelNames']
         dictOptions = self.buildDeviceSelector(strSelectorNames)
 
-        if dictOptions != Devices[SPOTIFYDEVICES].Options:
-            Devices[SPOTIFYDEVICES].Update(nValue=Devices[SPOTIFYDEVICES].nValue, sValue=Devices[SPOTIFYDEVICES].sValue, Options=dictOptions)
+        if dictOptions and dictOptions != selector.Options:
+            selector.Update(nValue=selector.nValue, sValue=selector.sValue, Options=dictOptions)
         
             
     def buildDeviceSelector(self, strSelectorNames):
 
+        self.deviceRegistry.refreshStarted()
+        _metrics.count('device refreshes')
         spotDevices = self.spotDevices()
-        if self.blDebug:
-            Domoticz.Log('JSON Returned from spotify listed available devices: ' + str(spotDevices))
-            
-        strSelectorActions = ''
-        
+        if spotDevices is None:
+            return None
 
-        lstSelectorNames=strSelectorNames.split("|")
-        
-        x=1
-        while x<len(lstSelectorNames):
-            strSelectorActions += '|'
-            x+=1
+        _log.debug('devices', 'Spotify listed available devices: %s', spotDevices)
 
-        
-        intCounter = (len(lstSelectorNames) * 10)
+        dictOptions = self.deviceRegistry.update(strSelectorNames, spotDevices)
 
-        for device in spotDevices['devices']:
-            if device['name'] not in lstSelectorNames:
-                strSelectorNames += '|' + device['name']
-                strSelectorActions += '|'
-                self.spotArrDevices.update({str(intCounter):device['id']})
-                intCounter += 10
-            else:
-                self.spotArrDevices.update({str(lstSelectorNames.index(device['name'])*10):device['id']})
-
-        if self.blDebug:
-            Domoticz.Log('Local array listing selector level with deviceids: ' + str(self.spotArrDevices))
-                
-
-        dictOptions = {"LevelActions": strSelectorActions,
-                       "LevelNames": strSelectorNames,
-                       "LevelOffHidden": "false",
-                       "SelectorStyle": "1"}
+        _log.debug('devices', 'Local array listing selector level with deviceids: %s', self.deviceRegistry.levelIds)
 
         return dictOptions
     
@@ -171,141 +1850,206 @@ class BasePlugin:
         
 
     def spotGetBearerHeader(self):
-        tokenSecElapsed = time.time() - float(self.spotifyToken['retrievaldate'])
-        if tokenSecElapsed > self.tokenexpired:
-            Domoticz.Log('Token expired, getting new one using refresh_token')
-            self.spotGetRefreshToken()
+        return self.tokenManager.bearerHeader()
 
-        return {"Authorization": "Bearer " + self.spotifyToken['access_token']}
+    def spotRequest(self, method, url, data=None, contentType=None, retry='all'):
+        #A token revoked or expired early is refreshed once and the request replayed
+        for attempt in range(2):
+            headers = self.spotGetBearerHeader()
+            if contentType:
+                headers['Content-Type'] = contentType
+            try:
+                return _spotifyApi.request(method, url, headers=headers, data=data, retry=retry)
+            except urllib.error.HTTPError as err:
+                if err.code != 401 or attempt > 0:
+                    raise
+                _log.info('player', 'Spotify rejected the access token, refreshing it and retrying')
+                self.tokenManager.refresh(headers['Authorization'][len('Bearer '):])
 
         
         
 
     def spotDevices(self):
         try:
-            url = self.spotifyApiUrl + '/me/player/devices'
-            headers = self.spotGetBearerHeader()
-
-            req = urllib.request.Request(url, headers=headers)
-            response = urllib.request.urlopen(req)
+            url = self.plugin.spotifyApiUrl + '/me/player/devices'
+            response = self.spotRequest('GET', url)
 
-            strResponse = response.read().decode('utf-8')
-            return json.loads(strResponse)
+            return [SpotifyDevice(device) for device in jsonField(parseJson(response), 'devices', [])]
         
+        except urllib.error.HTTPError as err:
+            _log.error('devices', "Unkown error: code: %s, msg: %s", err.code, err.msg)
+            return None
         except urllib.error.URLError as err:
-            Domoticz.Error("Unkown error: code: %s, msg: %s" % (str(err.code), str(err.args)))
+            _log.error('devices', "Could not reach spotify: %s", err.reason)
             return None
             
             
         
 
-    def getUserVar(self):
+    def startFavouritesRefresh(self):
+        self.favourites.refreshStarted()
+        _metrics.count('favourites refreshes')
+        apiUrl = self.plugin.spotifyApiUrl
+        self.favouritesRefresh = {'sources': [('playlist', apiUrl + '/me/playlists?limit=50', None, SearchItem),
+                                              ('album', apiUrl + '/me/albums?limit=50', None, SavedAlbum),
+                                              ('artist', apiUrl + '/me/following?type=artist&limit=50', 'artists', SearchItem)],
+                                  'url': None,
+                                  'entries': {}}
+
+    def refreshFavouritesPage(self):
+        """Reads the next page of the running favourites refresh, one page per job so
+        indexing never holds a worker or the rate limit for long. The index is only
+        replaced once all lists are read."""
+        refresh = self.favouritesRefresh
+        if refresh is None:
+            return
+        type, url, path, recordClass = refresh['sources'][0]
+        lstEntries = refresh['entries'].setdefault(type, [])
         try:
-            variables = DomoticzAPI({'type':'command','param':'getuservariables'}, self.blDebug)
-        
-            if variables:
-                valuestring = ""
-                missingVar = []
-                lstDomoticzVariables = list(self.spotifyToken.keys()) + self.spotifySearchParam
-                if "result" in variables:
-                    for intVar in lstDomoticzVariables:
-                        intVarName = Parameters["Name"] + '-' + intVar
-                        try:
-                            result = next((item for item in variables["result"] if item["Name"] == intVarName))
-                            if intVar in self.spotifyToken:
-                                self.spotifyToken[intVar] = result['Value']
-                            if self.blDebug:
-                                Domoticz.Log(str(result))
-                        except:
-                            missingVar.append(intVar)   
-                else:
-                    for intVar in lstDomoticzVariables:
-                        missingVar.append(intVar)
-                        
-                if len(missingVar) > 0:
-                    strMissingVar = ','.join(missingVar)
-                    Domoticz.Log("User Variable {} does not exist. Creation requested".format(strMissingVar))
-                    for variable in missingVar:
-                        DomoticzAPI({"type":"command","param":"saveuservariable","vname":Parameters["Name"] + '-' + variable,"vtype":"2","vvalue":""}, self.blDebug)
-                
-                return True
-            else:
-                raise Exception("Cannot read the uservariable holding the persistent variables")
-            
-        except Exception as error:
-            Domoticz.Error(str(error))
+            page = parseJson(self.spotRequest('GET', refresh['url'] or url))
+            if path:
+                page = jsonField(page, path, {})
+            for item in page.get('items') or []:
+                record = recordClass(item)
+                if record.name and record.uri:
+                    lstEntries.append([record.name, record.uri, record.artist])
+            refresh['url'] = page.get('next') if len(lstEntries) < FAVOURITES_MAX_ITEMS else None
+        except urllib.error.HTTPError as err:
+            if err.code not in (401, 403):
+                self.favouritesRefresh = None
+                raise
+            #Keep what we had, the token was authorised without the scope for this list
+            _log.info('search', 'Spotify did not allow reading your %ss (%s), authorise the playlist-read-private, user-library-read and user-follow-read scopes to index them', type, err.code)
+            refresh['entries'][type] = self.favourites.entries.get(type, [])
+            refresh['url'] = None
+        except Exception:
+            #Started again after FAVOURITES_MIN_REFRESH
+            self.favouritesRefresh = None
+            raise
+
+        if refresh['url']:
+            return
+        del refresh['sources'][0]
+        if refresh['sources']:
+            return
+        self.favouritesRefresh = None
+        self.favourites.replace(refresh['entries'])
+        self.favourites.save(self.favouritesFile)
+        _log.info('search', 'Indexed %s spotify favourites', self.favourites.count())
+
+    def createUserVar(self):
+        missingVar = []
+        lstDomoticzVariables = self.tokenStore.variableFields() + self.spotifySearchParam
+        for intVar in lstDomoticzVariables:
+            result = self.plugin.userVariables.get(self.varPrefix + '-' + intVar)
+            if result is None:
+                missingVar.append(intVar)
+                continue
+            _log.debug('variables', '%s', result)
+
+        if len(missingVar) > 0:
+            strMissingVar = ','.join(missingVar)
+            _log.info('variables', 'User Variable %s does not exist. Creation requested', strMissingVar)
+            for variable in missingVar:
+                DomoticzAPI({"type":"command","param":"saveuservariable","vname":self.varPrefix + '-' + variable,"vtype":"2","vvalue":""})
+            return True
+        return False
+
+    def registerSecrets(self):
+        _log.setSecret(self.varPrefix + '-code', self.code)
+        for field in ['access_token', 'refresh_token']:
+            _log.setSecret(self.varPrefix + '-' + field, self.spotifyToken[field])
+
+    def loadToken(self):
+        self.tokenStore.load(self.spotifyToken)
+        self.tokenManager.scheduleRefresh()
+        self.registerSecrets()
+
+    def revalidateToken(self):
+        dictStored = dict(self.spotifyToken)
+        self.tokenStore.load(dictStored)
+        if self.tokenManager.retrievalDate() < tokenRetrievalDate(dictStored):
+            #Renewed after the snapshot was written, e.g. by a start without it
+            self.spotifyToken.update(dictStored)
+            self.tokenManager.scheduleRefresh()
+            self.registerSecrets()
+        elif dictStored != self.spotifyToken:
+            self.saveUserVar()
+
+    def snapshot(self, blState=True):
+        #The playback state changes with every poll, without blState the saved one is kept
+        if blState:
+            self.savedState = self.lastState.snapshot() if self.lastState else None
+        return {'token': dict(self.spotifyToken),
+                'expiresIn': self.tokenManager.expiresIn,
+                'devices': self.deviceRegistry.snapshot(),
+                'state': self.savedState}
+
+    def restore(self, dictSnapshot):
+        dictToken = dictSnapshot.get('token') or {}
+        if not all(dictToken.get(field) for field in self.spotifyToken):
+            return False
+        for field in self.spotifyToken:
+            self.spotifyToken[field] = str(dictToken[field])
+        self.tokenManager.expiresIn = int(dictSnapshot.get('expiresIn') or 3600)
+        self.tokenManager.scheduleRefresh()
+        self.registerSecrets()
+        self.deviceRegistry.restore(dictSnapshot.get('devices') or {})
+        if dictSnapshot.get('state'):
+            self.savedState = dictSnapshot['state']
+            self.lastState = PlaybackState.restore(self.savedState)
+        return True
 
         
             
 
     def saveUserVar(self):
         try:
-            for intVar in self.spotifyToken:
-                intVarName = Parameters["Name"] + '-' + intVar
-                DomoticzAPI({"type":"command","param":"updateuservariable","vname":intVarName,"vtype":"2","vvalue":str(self.spotifyToken[intVar])}, self.blDebug)
+            self.tokenStore.save(self.spotifyToken)
         except Exception as error:
-            Domoticz.Error(str(error))
+            _log.error('token', '%s', error)
 
     def spotGetRefreshToken(self):
         try:
             
-            url = self.spotifyAccountUrl
-            headers = self.returnSpotifyBasicHeader()
+            url = self.plugin.spotifyAccountUrl
+            headers = self.plugin.returnSpotifyBasicHeader()
 
             data = {'grant_type':'refresh_token',
                     'refresh_token': self.spotifyToken['refresh_token']}
             data = urllib.parse.urlencode(data)
 
-            req = urllib.request.Request(url, data.encode('ascii'), headers)
-            response = urllib.request.urlopen(req)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            response = _spotifyApi.request('POST', url, headers=headers, data=data.encode('ascii'))
 
             strResponse= response.read().decode('utf-8')
-            if self.blDebug:
-                Domoticz.Log('Spotify response accestoken based on refresh: ' + str(strResponse))
-                
+            _log.debug('token', 'Spotify response accestoken based on refresh: %s', strResponse)
+
             jsonResponse = json.loads(strResponse)
 
             self.saveSpotifyToken(jsonResponse)
         except:
-            Domoticz.Error('Seems something with wrong with token response from spotify') 
-
-    def returnSpotifyBasicHeader(self):
-
-        client_id = Parameters["Mode1"] 
-        client_secret = Parameters["Mode2"] 
-        login = client_id + ':' + client_secret
-        base64string = base64.b64encode(login.encode())
-        header = {'Authorization': 'Basic ' + base64string.decode('ascii')}
-        if self.blDebug:
-            Domoticz.Log('For basic headers using client_id: %s, client_secret: %s' % (client_id, client_secret))
-
-        return header
-        
-    
-   
+            _log.error('token', 'Seems something with wrong with token response from spotify')
 
     def spotAuthoriseCode(self):
         try:
-            code = Parameters["Mode3"]
-            url = self.spotifyAccountUrl
+            code = self.code
+            url = self.plugin.spotifyAccountUrl
             data = {'grant_type':'authorization_code',
                     'code':code,
                     'redirect_uri':'http://localhost'}
-            if self.blDebug:
-                Domoticz.Log('Getting tokens using data: %s' % (data))
+            _log.debug('token', 'Getting tokens using data: %s', data)
             data = urllib.parse.urlencode(data)
             
-            headers = self.returnSpotifyBasicHeader()
-            if self.blDebug:
-                Domoticz.Log('Getting tokens using header: %s' % (headers))
+            headers = self.plugin.returnSpotifyBasicHeader()
+            _log.debug('token', 'Getting tokens using header: %s', headers)
 
             try:
-                req = urllib.request.Request(url, data.encode('ascii'), headers)
-                response = urllib.request.urlopen(req)
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                response = _spotifyApi.request('POST', url, headers=headers, data=data.encode('ascii'))
 
                 strResponse= response.read().decode('utf-8')
-                if self.blDebug:
-                    Domoticz.Log('Spotify tokens based on authorisation code: ' + str(strResponse))
+                _log.debug('token', 'Spotify tokens based on authorisation code: %s', strResponse)
                 jsonResponse = json.loads(strResponse)
                     
 
@@ -317,10 +2061,10 @@ class BasePlugin:
                 errmsg = "Error occured in request for getting acces_tokens from Spotify, error code: %s, reason: %s." %(err.code,err.reason)
                 if err.code == 400:
                     errmsg += " Seems either client_id, client_secret or code is incorrect. Please note that the code received from Spotify could only be used once. Please get a new one from spotify."
-                Domoticz.Error(errmsg)
+                _log.error('token', '%s', errmsg)
             
         except Exception as error:
-            Domoticz.Error(error)
+            _log.error('token', '%s', error)
 
             
             
@@ -330,198 +2074,695 @@ class BasePlugin:
                 if intVar in response:
                     self.spotifyToken[intVar] = response[intVar]
             self.spotifyToken['retrievaldate'] = time.time()
-            Domoticz.Log('Succesfully got spotify tokens, saving data in user domoticz user variables')
+            self.tokenManager.tokenUpdated(response)
+            self.registerSecrets()
+            _log.info('token', 'Succesfully got spotify tokens, saving data in user domoticz user variables')
             self.saveUserVar()
         except:
-            Domoticz.Error('Seems something with wrong with token response from spotify')
-
-    def spotSearch(self, input, type):
+            _log.error('token', 'Seems something with wrong with token response from spotify')
 
+    def favouriteSearch(self, input, type):
+        if not FAVOURITES_INDEX or type == 'track':
+            return None
+        entry = self.favourites.lookup(type, input)
+        _metrics.count('favourites hits' if entry else 'favourites misses')
+        if not entry:
+            return None
+        _log.info('search', 'Found %s %s in favourites', type, entry[0])
+        return {"context_uri": entry[1]}
+
+    def spotSearch(self, input, type, blFavourites=True, blSave=True):
+
+        favourite = self.favouriteSearch(input, type) if blFavourites else None
+        if favourite:
+            return favourite
+
+        searchCache = self.plugin.searchCache
+        cacheKey = (input.lower(), type, self.plugin.spotifyMarket)
+        cached = searchCache.get(cacheKey)
+        _metrics.count('search cache hits' if cached else 'search cache misses')
+        _log.debug('search', 'Search cache %s for %s, hits: %s, misses: %s', 'hit' if cached else 'miss', cacheKey, searchCache.hits, searchCache.misses)
+        if cached:
+            _log.info('search', '%s (cached)', cached['log'])
+            return cached['play']
         
-        url = self.spotifyApiUrl + "/search?q=%s&type=%s&market=NL&limit=10" % (urllib.parse.quote(input), type)
-        if self.blDebug:
-            Domoticz.Log('Spotify search url: ' + str(url))
+        #Only tracks play more than the first result
+        intLimit = SEARCH_TRACK_LIMIT if type == 'track' else 1
+        url = self.plugin.spotifyApiUrl + "/search?q=%s&type=%s&market=%s&limit=%s" % (urllib.parse.quote(input), type, self.plugin.spotifyMarket, intLimit)
+        _log.debug('search', 'Spotify search url: %s', url)
             
-        headers = self.spotGetBearerHeader()
-
-        req = urllib.request.Request(url, headers=headers)
-        response = urllib.request.urlopen(req)
+        response = self.spotRequest('GET', url)
 
-        jsonResponse = json.loads(response.read().decode('utf-8'))
-        foundItems = jsonResponse['%ss' % type]['items']
+        foundItems = [SearchItem(item) for item in jsonField(parseJson(response), type + 's.items', [])]
+        if not foundItems:
+            raise Exception('Spotify found no %s for %s' % (type, input))
 
-        if self.blDebug:
-            Domoticz.Log('First result of spotify search: ' + str(foundItems[0]))
+        _log.debug('search', 'First result of spotify search: %s', foundItems[0])
             
-        rsltString = 'Found ' + type + ' ' + foundItems[0]['name']
+        rsltString = 'Found ' + type + ' ' + foundItems[0].name
         if type == 'track':
-            tracks = []
-            for track in foundItems:
-                tracks.append(track['uri'])
-            returnData = {"uris": tracks}
+            returnData = {"uris": [track.uri for track in foundItems]}
         else:
-            returnData = {"context_uri": foundItems[0]['uri']}
+            returnData = {"context_uri": foundItems[0].uri}
 
-        if type  == 'album' or type == 'track':
-            rsltString += ' by ' + foundItems[0]['artists'][0]['name']
+        if (type  == 'album' or type == 'track') and foundItems[0].artist:
+            rsltString += ' by ' + foundItems[0].artist
             
-        Domoticz.Log(rsltString) 
+        _log.info('search', '%s', rsltString)
+        searchCache.put(cacheKey, {'play': returnData, 'log': rsltString})
+        if blSave and self.plugin.searchCacheFile:
+            searchCache.save(self.plugin.searchCacheFile)
         return returnData
 
+    def contextTracks(self, uri):
+        """Track uris of an album, playlist or the top tracks of an artist"""
+        searchCache = self.plugin.searchCache
+        cacheKey = (uri, 'tracks', self.plugin.spotifyMarket)
+        cached = searchCache.get(cacheKey)
+        if cached:
+            return cached['play']['uris']
+
+        type, id = uri.split(':')[-2:]
+        apiUrl = self.plugin.spotifyApiUrl
+        market = self.plugin.spotifyMarket
+        if type == 'playlist':
+            url = apiUrl + '/playlists/%s/tracks?fields=items(track(uri))&limit=%s&market=%s' % (id, PLAN_TRACKS_PER_ITEM, market)
+            lstTracks = [PlaylistTrackUri(item) for item in jsonField(parseJson(self.spotRequest('GET', url)), 'items', [])]
+        elif type == 'album':
+            url = apiUrl + '/albums/%s/tracks?limit=%s&market=%s' % (id, PLAN_TRACKS_PER_ITEM, market)
+            lstTracks = [TrackUri(item) for item in jsonField(parseJson(self.spotRequest('GET', url)), 'items', [])]
+        elif type == 'artist':
+            url = apiUrl + '/artists/%s/top-tracks?market=%s' % (id, market)
+            lstTracks = [TrackUri(item) for item in jsonField(parseJson(self.spotRequest('GET', url)), 'tracks', [])][:PLAN_TRACKS_PER_ITEM]
+        else:
+            raise Exception('Cannot get the tracks of ' + uri)
+
+        lstUris = [track.uri for track in lstTracks if track.uri]
+        searchCache.put(cacheKey, {'play': {'uris': lstUris}, 'log': ''})
+        return lstUris
+
+    def planTracks(self, input, type):
+        #spotPlan saves the cache once for the whole plan
+        searchResult = self.spotSearch(input, type, blSave=False)
+        if 'uris' in searchResult:
+            return searchResult['uris']
+        return self.contextTracks(searchResult['context_uri'])
+
+    def spotPlan(self, lstQueries):
+        """Resolves the (query, type) items of a playback plan concurrently and merges
+        their tracks into one play request"""
+        _metrics.count('playback plans')
+        lstQueries = list(collections.OrderedDict.fromkeys(lstQueries))
+        lstResults = runConcurrently([(self.planTracks, input, type) for input, type in lstQueries])
+
+        lstUris = []
+        setSeen = set()
+        for (input, type), result in zip(lstQueries, lstResults):
+            if isinstance(result, Exception):
+                _log.error('search', 'Could not resolve %s %s: %s', type, input, result)
+                continue
+            for uri in result:
+                if uri not in setSeen:
+                    setSeen.add(uri)
+                    lstUris.append(uri)
+
+        if self.plugin.searchCacheFile:
+            self.plugin.searchCache.save(self.plugin.searchCacheFile)
+        if not lstUris:
+            raise Exception('None of the searches of the playback plan found tracks')
+        _log.info('search', 'Playback plan of %s searches resolved into %s tracks', len(lstQueries), len(lstUris))
+        return {"uris": lstUris[:PLAN_MAX_TRACKS]}
+
+    def parseSearch(self, searchString):
+        for type in ['artist','track','playlist','album']:
+            if type in searchString:
+                strippedSearch = searchString.replace(type,'',1).strip()
+                _log.debug('search', 'Search type: %s, search string: %s', type, strippedSearch)
+                return strippedSearch, type
+        return None
+
     def spotPause(self):
         try:
 
-            url = self.spotifyApiUrl + "/me/player/pause"
-            headers = self.spotGetBearerHeader()
-
-            req = urllib.request.Request(url, headers=headers, method='PUT')
-            response = urllib.request.urlopen(req)
-            Domoticz.Log("Succesfully paused track")
+            url = self.plugin.spotifyApiUrl + "/me/player/pause"
+            self.spotRequest('PUT', url)
+            _log.info('player', "Succesfully paused track")
 
         except urllib.error.HTTPError as err:
             if err.code == 403:
-                Domoticz.Error("User non premium")
+                _log.error('player', "User non premium")
             elif err.code == 400:
-                Domoticz.Error("Device id not found")
+                _log.error('player', "Device id not found")
+            elif err.code == 429:
+                _log.error('player', "Spotify rate limit reached, pause not send")
             else:
-                Domoticz.Error("Unkown error, msg: " + str(err.msg))
+                _log.error('player', "Unkown error, msg: %s", err.msg)
+        except urllib.error.URLError as err:
+            _log.error('player', "Could not reach spotify to pause: %s", err.reason)
 
     def spotCurrent(self):
         try:
 
-            url = self.spotifyApiUrl + "/me/player"
-            headers = self.spotGetBearerHeader()
+            url = self.plugin.spotifyApiUrl + "/me/player"
+            response = self.spotRequest('GET', url)
 
-            req = urllib.request.Request(url, headers=headers, method='GET')
-            response = urllib.request.urlopen(req)
-            
-
-            if self.blDebug == True:
-                Domoticz.Log("Succesfully retrieved current playing state")
-                Domoticz.Log('Retrieved current playing state having code %s' % (response.code))
+            _log.debug('poll', 'Retrieved current playing state having code %s', response.code)
 
 
             return response
 
         except urllib.error.HTTPError as err:
-            Domoticz.Error("Unkown error %s, msg: %s" % (err.code, err.msg))
+            if err.code == 429:
+                retryAfter = retryAfterSeconds(err)
+                _log.info('poll', "Spotify rate limit reached, not polling for %s seconds", retryAfter)
+                self.poller.rateLimited(retryAfter)
+            else:
+                _log.error('poll', "Unkown error %s, msg: %s", err.code, err.msg)
+        except urllib.error.URLError as err:
+            _log.error('poll', "Could not reach spotify for playing state: %s", err.reason)
     
     def spotPlay(self, input, deviceLvl):
 
         try:
 
-            if deviceLvl not in self.spotArrDevices:
-                self.updateDeviceSelector()
-                if deviceLvl not in self.spotArrDevices:
+            device = self.deviceRegistry.deviceId(deviceLvl)
+            if device is None:
+                self.updateDeviceSelector(True)
+                device = self.deviceRegistry.deviceId(deviceLvl)
+                if device is None:
                     raise urllib.error.HTTPError(url='',msg='',hdrs='', fp='', code=404)
             
-            device = self.spotArrDevices[deviceLvl]
-            url = self.spotifyApiUrl + "/me/player/play?device_id=" + device  
-            headers = self.spotGetBearerHeader()
-
+            url = self.plugin.spotifyApiUrl + "/me/player/play?device_id=" + device  
             data = json.dumps(input).encode('utf8')
 
-
-            req = urllib.request.Request(url, headers=headers, data=data, method='PUT')
-            response = urllib.request.urlopen(req)
-            self.updateDomoticzDevice(SPOTIFYDEVICES, 1, str(deviceLvl))
-            Domoticz.Log("Succesfully started playback")
+            try:
+                self.spotRequest('PUT', url, data, 'application/json')
+            except urllib.error.HTTPError as err:
+                if err.code != 404 or not PREWARM_DEVICE:
+                    raise
+                #An idle device is often not ready yet, wake it with a transfer and retry once with the cached id
+                _log.info('player', "Device not ready, transferring playback to it and retrying")
+                if not self.spotTransfer(device):
+                    raise
+                self.spotRequest('PUT', url, data, 'application/json')
+            self.plugin.updateDomoticzDevice(self.unit(SPOTIFYDEVICES), 1, str(deviceLvl))
+            _log.info('player', "Succesfully started playback")
 
         except urllib.error.HTTPError as err:
             if err.code == 403:
-                Domoticz.Error("Error playback, you need to be premium member")
+                _log.error('player', "Error playback, you need to be premium member")
             elif err.code == 400:
-                Domoticz.Error("Error playback, right scope requested?")
+                _log.error('player', "Error playback, right scope requested?")
             elif err.code == 404:
-                Domoticz.Error("Device not found, went offline?")
+                _log.error('player', "Device not found, went offline?")
+                #Let the heartbeat refresh the device list in the background
+                self.deviceRegistry.updated = 0
+            elif err.code == 429:
+                _log.error('player', "Error playback, spotify rate limit reached")
             else:
-                Domoticz.Error("Unkown error, msg: " + str(err.msg))
+                _log.error('player', "Unkown error, msg: %s", err.msg)
+        except urllib.error.URLError as err:
+            _log.error('player', "Error playback, could not reach spotify: %s", err.reason)
         
 
-    def onHeartbeat(self):
-        if not self.blError:
-            if Parameters["Mode5"] != "0" and self.heartbeatCounterPoll == int(Parameters["Mode5"]):
-                if self.blDebug:
-                    Domoticz.Log('Polling')
-                response = self.spotCurrent()
-                if response.code == 204 and Devices[SPOTIFYDEVICES].sValue != '0':
-                    self.updateDomoticzDevice(SPOTIFYDEVICES, 0, "0")
-                elif response.code == 200:
-                    resultJson = json.loads(response.read().decode('utf-8'))
-
-                    try:
-                        if resultJson['is_playing'] == False:
-                            self.updateDomoticzDevice(SPOTIFYDEVICES, 0, "0")
-                        else:
-                            lstSelectorLevel = catchDeviceSelectorLvl(resultJson['device']['name'])
-                            self.updateDomoticzDevice(SPOTIFYDEVICES, 1, lstSelectorLevel)
-                                
-                    except ValueError:
-                        try:
-                            if self.blDebug:
-                                Domoticz.Log('Playing on device %s which was unkown, trying to update domoticz device to correctly update playback information.' % (str(resultJson['device']['name'])))
-                            self.updateDeviceSelector()
-                            lstSelectorLevel = catchDeviceSelectorLvl(resultJson['device']['name'])
-                            self.updateDomoticzDevice(SPOTIFYDEVICES, 1, lstSelectorLevel)
-                        except ValueError:
-                            Domoticz.Error("Current playing device not found by domoticz, cant update")
-                        
-
-                    except UnicodeEncodeError:
-                        #jsonresult is empty, meaning nothing is playing
-                        self.updateDomoticzDevice(SPOTIFYDEVICES, 0, "0")
-                        
-                    
-                self.heartbeatCounterPoll = 1
-            else:
-                self.heartbeatCounterPoll += 1
-            
+    def spotTransfer(self, device):
+        """Moves playback to the device without starting it, so it is awake when play arrives"""
+        try:
+            url = self.plugin.spotifyApiUrl + "/me/player"
+            data = json.dumps({"device_ids": [device], "play": False}).encode('utf8')
+            self.spotRequest('PUT', url, data, 'application/json')
+            _metrics.count('device transfers')
             return True
+        except urllib.error.URLError as err:
+            #Play reports the problem if there really is one
+            _log.debug('player', 'Transfer to device %s failed: %s', device, err)
+            return False
+
+    def needsPrewarm(self, lstQueries):
+        #A transfer keeps playing what plays now, which would move the old track to the target device
+        if Devices[self.unit(SPOTIFYDEVICES)].nValue != 0:
+            return False
+        if len(lstQueries) > 1:
+            return True
+        #Nothing to overlap with when the search is answered from the cache
+        input, type = lstQueries[0]
+        return not self.plugin.searchCache.contains((input.lower(), type, self.plugin.spotifyMarket))
+
+    def resolveSearch(self, lstQueries):
+        if len(lstQueries) == 1:
+            #handleCommand already looked in the favourites
+            input, type = lstQueries[0]
+            return self.spotSearch(input, type, False)
+        return self.spotPlan(lstQueries)
+
+    def pollPlayback(self):
+        _log.debug('poll', 'Polling')
+        response = self.spotCurrent()
+        if response is None:
+            self.poller.idle()
+        elif response.code == 204:
+            self.poller.idle()
+            self.updatePlaybackDevices(None)
+        elif response.code == 200:
+            state = PlaybackState(parseJson(response))
+            if state.isPlaying:
+                self.poller.playing(state.progressMs, state.durationMs)
+            else:
+                self.poller.idle()
+            self.updatePlaybackDevices(state)
 
-    def updateDomoticzDevice(self, idx, nValue, sValue):
-        if Devices[idx].sValue != sValue or Devices[idx].nValue != nValue:
-            if self.blDebug == True:
-                Domoticz.Log('Update for device %s with nValue: %s and sValue %s' % (idx, nValue, sValue))
-            Devices[idx].Update(nValue, sValue)
-
-            
-
-    def onCommand(self, Unit, Command, Level, Hue):
-        if (self.blDebug ==  True):
-            Domoticz.Log("Spotify: onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
-            Domoticz.Log("nValue=%s, sValue=%s" % (str(Devices[SPOTIFYDEVICES].nValue), str(Devices[SPOTIFYDEVICES].sValue)))
-
-        if Unit == SPOTIFYDEVICES:
-            try:
-                variables = DomoticzAPI({'type':'command','param':'getuservariables'}, self.blDebug)
-            except Exception as error:
-                Domoticz.Error(error)
+    def updatePlaybackDevices(self, state):
+        #Every device is only updated when its value changed
+        intUnit = self.unit(SPOTIFYDEVICES)
+        try:
+            if state is None or not state.isPlaying:
+                self.plugin.updateDomoticzDevice(intUnit, 0, "0")
+            else:
+                deviceName = state.deviceName
+                lstSelectorLevel = self.deviceRegistry.levelForName(deviceName, Devices[intUnit].Options['LevelNames'])
+                if lstSelectorLevel is None:
+                    _log.debug('devices', 'Playing on device %s which was unkown, trying to update domoticz device to correctly update playback information.', deviceName)
+                    self.updateDeviceSelector(True)
+                    lstSelectorLevel = self.deviceRegistry.levelForName(deviceName, Devices[intUnit].Options['LevelNames'])
+
+                if lstSelectorLevel is None:
+                    _log.error('devices', "Current playing device not found by domoticz, cant update")
+                else:
+                    self.plugin.updateDomoticzDevice(intUnit, 1, lstSelectorLevel)
+
+        except UnicodeEncodeError:
+            #jsonresult is empty, meaning nothing is playing
+            self.plugin.updateDomoticzDevice(intUnit, 0, "0")
+
+        self.lastState = state
+        if state is None:
+            self.plugin.updateDomoticzDevice(self.unit(NOWPLAYING), 0, '')
+            return
+
+        self.plugin.updateDomoticzDevice(self.unit(NOWPLAYING), 0, state.nowPlaying())
+        if state.volumePercent is not None:
+            self.plugin.updateDomoticzDevice(self.unit(VOLUME), 2 if state.volumePercent > 0 else 0, str(state.volumePercent))
+        self.plugin.updateDomoticzDevice(self.unit(SHUFFLE), 1 if state.shuffle else 0, 'On' if state.shuffle else 'Off')
+        strRepeat = REPEAT_LEVELS.get(state.repeat, '0')
+        self.plugin.updateDomoticzDevice(self.unit(REPEAT), 0 if strRepeat == '0' else 1, strRepeat)
+        intProgress = state.progressPercent()
+        if intProgress is not None:
+            self.plugin.updateDomoticzDevice(self.unit(PROGRESS), 0, str(intProgress))
+
+    def spotPlayerCommand(self, method, path, description):
+        try:
+            #Skipping twice is worse than not skipping, POST is only retried when it was not sent
+            self.spotRequest(method, self.plugin.spotifyApiUrl + path, retry='connect' if method == 'POST' else 'all')
+            _log.info('player', "Succesfully %s", description)
+            self.poller.commandSent()
+            return True
 
+        except urllib.error.HTTPError as err:
+            if err.code == 403:
+                _log.error('player', "Error %s, you need to be premium member", description)
+            elif err.code == 404:
+                _log.error('player', "Error %s, no active spotify device", description)
+            elif err.code == 429:
+                _log.error('player', "Error %s, spotify rate limit reached", description)
+            else:
+                _log.error('player', "Unkown error %s, msg: %s", description, err.msg)
+        except urllib.error.URLError as err:
+            _log.error('player', "Error %s, could not reach spotify: %s", description, err.reason)
+        return False
+
+    def handleTransport(self, Unit, Command, Level):
+        intOffset = Unit - self.unitBase
+        if intOffset == VOLUME:
+            intVolume = int(Level)
+            if Command == 'Off':
+                intVolume = 0
+            elif Command == 'On':
+                intVolume = int(Devices[Unit].sValue or 0) or 50
+            if self.spotPlayerCommand('PUT', '/me/player/volume?volume_percent=%s' % (intVolume), 'set volume to %s' % (intVolume)):
+                self.plugin.updateDomoticzDevice(Unit, 2 if intVolume > 0 else 0, str(intVolume))
+
+        elif intOffset == SHUFFLE:
+            blShuffle = Command == 'On'
+            if self.spotPlayerCommand('PUT', '/me/player/shuffle?state=%s' % ('true' if blShuffle else 'false'), 'set shuffle ' + Command.lower()):
+                self.plugin.updateDomoticzDevice(Unit, 1 if blShuffle else 0, 'On' if blShuffle else 'Off')
+
+        elif intOffset == REPEAT:
+            strLevel = str(Level) if Command != 'Off' else '0'
+            for strState, strRepeatLevel in REPEAT_LEVELS.items():
+                if strRepeatLevel == strLevel:
+                    if self.spotPlayerCommand('PUT', '/me/player/repeat?state=' + strState, 'set repeat ' + strState):
+                        self.plugin.updateDomoticzDevice(Unit, 0 if strLevel == '0' else 1, strLevel)
+
+        elif intOffset == NEXT:
+            self.spotPlayerCommand('POST', '/me/player/next', 'skipped to next track')
+
+        elif intOffset == PREVIOUS:
+            self.spotPlayerCommand('POST', '/me/player/previous', 'skipped to previous track')
+
+        elif intOffset == SEEK:
+            if self.lastState is None or not self.lastState.durationMs:
+                _log.error('player', "Cannot seek, length of the current track unknown")
+                return
+            intPosition = self.lastState.durationMs * int(Level) // 100
+            self.spotPlayerCommand('PUT', '/me/player/seek?position_ms=%s' % (intPosition), 'seeked to %s%%' % (Level))
+
+    def handleCommand(self, Unit, Command, Level):
+        if Unit == self.unit(SPOTIFYDEVICES):
             if Level == 0:
                 #Spotify turned off
-                self.updateDomoticzDevice(Unit, 0, str(Level))
+                self.plugin.updateDomoticzDevice(Unit, 0, str(Level))
                 self.spotPause()
+                self.poller.commandSent()
                 
             else:
-                searchVariable = next((item for item in variables["result"] if item["Name"] == Parameters["Name"] + '-searchTxt'))
-                searchString = searchVariable['Value']
-                Domoticz.Log('Looking for ' + searchString)
+                try:
+                    searchVariable = self.plugin.userVariables.fetch(self.varPrefix + '-searchTxt')
+                except Exception as error:
+                    _log.error('player', '%s', error)
+                    return
+
+                searchString = searchVariable['Value'] if searchVariable else ""
+                _log.info('player', 'Looking for %s', searchString)
                 searchResult = None
 
-                if searchString != "":
-                    for type in ['artist','track','playlist','album']:
-                        if type in searchString:
-                            strippedSearch = searchString.replace(type,'').lstrip()
-                            if self.blDebug:
-                                Domoticz.Log('Search type: ' + type)
-                                Domoticz.Log('Search string: ' + strippedSearch)
-                            searchResult = self.spotSearch(strippedSearch,type)
-                            break
+                lstQueries = [self.parseSearch(part) for part in searchString.split(PLAN_SEPARATOR) if part.strip()]
+                if len(lstQueries) == 1 and lstQueries[0]:
+                    searchResult = self.favouriteSearch(*lstQueries[0])
+                if searchResult is None and lstQueries and None not in lstQueries:
+                    device = self.deviceRegistry.deviceId(str(Level))
+                    if PREWARM_DEVICE and device and self.needsPrewarm(lstQueries):
+                        #Wake the device up while the search runs instead of after it
+                        blTransferred, searchResult = runConcurrently([(self.spotTransfer, device), (self.resolveSearch, lstQueries)])
+                        if isinstance(searchResult, Exception):
+                            raise searchResult
+                    else:
+                        searchResult = self.resolveSearch(lstQueries)
 
                 if not searchResult:
-                    Domoticz.Error("No correct type found in search string, use either artist, track, playlist or album")
+                    _log.error('player', "No correct type found in search string, use either artist, track, playlist or album")
                 else:
                     self.spotPlay(searchResult,str(Level))
+                    self.poller.commandSent()
+
+
+#############################################################################
+#                      Domoticz call back functions                         #
+#############################################################################
+class BasePlugin:
+    def __init__(self):
+        self.accounts = []
+        self.spotifyAccountUrl = "https://accounts.spotify.com/api/token"
+        self.spotifyApiUrl = "https://api.spotify.com/v1"
+        self.spotifyMarket = "NL"
+        self.searchCache = LruCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+        self.searchCacheFile = None
+        self.blError = False
+        self.commandQueue = CommandQueue(COMMAND_WORKERS)
+        self.connectListener = None
+        self.stateSnapshot = None
+        self.createdUnits = None
+        self.revalidateAt = None
+        self.favouritesAfter = 0
+        self.blStarting = False
+        self.userVariables = UserVariableStore()
+        
+
+    def onStart(self):
+
+        
+
+        _log.level = PluginLogger.DEBUG if Parameters["Mode6"] == "Debug" else PluginLogger.INFO
+        for var in ['Mode2', 'Mode3', 'Password']:
+            _log.setSecret(var, Parameters.get(var))
+        self.favouritesAfter = time.time() + FAVOURITES_START_DELAY
+        if LOG_JSON_SINK:
+            _log.openSink(os.path.join(Parameters["HomeFolder"], Parameters["Name"] + '-log.jsonl'))
+
+        for var in ['Mode1','Mode2','Mode3']:
+            if Parameters[var] == "":
+                _log.error('plugin', 'No client_id, client_secret and/or code is set in hardware parameters')
+                self.blError = True
+                return None
+
+        self.accounts = [SpotifyAccount(self, 0, Parameters["Name"], '', Parameters["Mode3"])]
+        for name, code in parseAccounts(Parameters["Mode4"]):
+            self.accounts.append(SpotifyAccount(self, len(self.accounts), Parameters["Name"] + '-' + name, name, code))
+
+        if SEARCH_CACHE_PERSIST:
+            self.searchCacheFile = os.path.join(Parameters["HomeFolder"], Parameters["Name"] + '-searchcache.json')
+            self.searchCache.load(self.searchCacheFile)
+
+        if FAVOURITES_INDEX:
+            for account in self.accounts:
+                account.favourites.load(account.favouritesFile)
+
+        self.createdUnits = CreatedUnits(os.path.join(Parameters["HomeFolder"], Parameters["Name"] + '-units.json'))
+
+        if WARM_START:
+            self.stateSnapshot = StateSnapshot(os.path.join(Parameters["HomeFolder"], Parameters["Name"] + '-state.json'))
+            if self.restoreSnapshot(self.stateSnapshot.load()):
+                _log.info('plugin', 'Started from the saved state, revalidating it in the background')
+                self.revalidateAt = time.time()
+
+        #Stagger the first polls of the accounts over successive heartbeats
+        for account in self.accounts:
+            account.poller.maxInterval = int(Parameters["Mode5"]) * 30
+            account.poller.nextPoll = time.time() + account.index * POLL_HEARTBEAT
+
+        if HTTP_TRANSPORT == 'domoticz' and self.commandQueue.workers < 1:
+            #Inline jobs would wait on this thread for responses that arrive on it
+            _log.error('plugin', "HTTP_TRANSPORT 'domoticz' needs COMMAND_WORKERS of at least 1, using 1")
+            self.commandQueue.workers = 1
+        self.commandQueue.start()
+        if HTTP_TRANSPORT == 'domoticz':
+            #Responses arrive on this thread, so the start can not wait for them here
+            self.blStarting = True
+            self.commandQueue.put('start', self.startAccounts)
+        elif not self.startAccounts():
+            return None
+
+        if LOCAL_DISCOVERY:
+            self.connectListener = ConnectListener(self.localPlaybackChanged)
+            self.connectListener.start()
+        Domoticz.Heartbeat(POLL_HEARTBEAT)
+
+
+    def startAccounts(self):
+        try:
+            if self.revalidateAt is None and not self.getUserVar():
+                self.blError = True
+                return False
+
+            for account in self.accounts:
+                for key, value in account.spotifyToken.items():
+                    if value == '':
+                        _log.info('plugin', "Not all spotify token variables are available, let's get it")
+                        if not account.spotAuthoriseCode():
+                            if account.index == 0:
+                                self.blError = True
+                                return False
+                            _log.error('plugin', 'Could not authorise extra account %s, disabling it', account.name)
+                            account.blError = True
+                        break
+
+            self.checkDevices()
+
+            if self.revalidateAt is not None:
+                self.revalidateAt = time.time() + WARM_START_RETRY
+                self.commandQueue.put('revalidate', self.revalidate)
+            return True
+        finally:
+            #Commands are no longer blocked, also when the start failed
+            self.blStarting = False
+
+    def onStop(self):
+        if self.connectListener:
+            self.connectListener.stop()
+        if isinstance(_httpPool, DomoticzTransport):
+            #Workers waiting on a response would never get it once the plugin stops
+            _httpPool.close()
+        self.commandQueue.stop()
+        if self.stateSnapshot and not self.blError:
+            self.stateSnapshot.save(self.snapshot())
+        _httpPool.close()
+
+    def snapshot(self, blState=True):
+        return {'accounts': dict((account.varPrefix, account.snapshot(blState)) for account in self.accounts)}
+
+    def restoreSnapshot(self, dictSnapshot):
+        #Only when every configured account is in the snapshot, otherwise start as usual
+        dictAccounts = (dictSnapshot or {}).get('accounts') or {}
+        if not all(account.varPrefix in dictAccounts for account in self.accounts):
+            return False
+        return all([account.restore(dictAccounts[account.varPrefix]) for account in self.accounts])
+
+    def revalidate(self):
+        self.checkUserVar()
+        for account in self.accounts:
+            account.revalidateToken()
+        self.revalidateAt = None
+        for account in self.activeAccounts():
+            account.updateDeviceSelector(True)
+
+
+    def activeAccounts(self):
+        return [account for account in self.accounts if not account.blError]
+
+    def accountForUnit(self, Unit):
+        intIndex = (Unit - 1) // UNITS_PER_ACCOUNT
+        if intIndex < len(self.accounts) and not self.accounts[intIndex].blError:
+            return self.accounts[intIndex]
+        return None
+
+    def checkDevices(self):
+        self.createdUnits.load()
+        for account in self.activeAccounts():
+            account.checkDevices()
+
+        self.createdUnits.create(STATISTICSTEXT, Name="statistics", Used=0, TypeName="Text")
+        self.createdUnits.create(STATISTICSCALLS, Name="api calls", Used=0, TypeName="Custom", Options={"Custom": "1;calls"})
+        self.createdUnits.create(STATISTICSLATENCY, Name="api latency", Used=0, TypeName="Custom", Options={"Custom": "1;ms"})
+        self.createdUnits.save()
+
+    def checkUserVar(self):
+        if not self.userVariables.refresh():
+            raise Exception("Cannot read the uservariable holding the persistent variables")
+
+        blCreated = False
+        for account in self.accounts:
+            blCreated = account.createUserVar() or blCreated
+
+        if blCreated:
+            #Pick up the idx of the created variables
+            self.userVariables.refresh()
+
+    def getUserVar(self):
+        try:
+            self.checkUserVar()
+            for account in self.accounts:
+                account.loadToken()
+            return True
+            
+        except Exception as error:
+            _log.error('plugin', '%s', error)
+
+    def returnSpotifyBasicHeader(self):
+
+        client_id = Parameters["Mode1"] 
+        client_secret = Parameters["Mode2"] 
+        login = client_id + ':' + client_secret
+        base64string = base64.b64encode(login.encode())
+        header = {'Authorization': 'Basic ' + base64string.decode('ascii')}
+        _log.debug('token', 'For basic headers using client_id: %s', client_id)
+
+        return header
+        
+
+    def onHeartbeat(self):
+        if not self.blError and not self.blStarting:
+            lstDue = []
+            for account in self.activeAccounts():
+                if account.tokenManager.needsRefresh():
+                    #Renew ahead of expiry in the background so commands never wait on it
+                    self.commandQueue.put(('token', account.index), account.tokenManager.refresh, account.spotifyToken['access_token'])
+
+                if not account.deviceRegistry.isFresh() and account.deviceRegistry.mayRefresh():
+                    self.commandQueue.put(('devices', account.index), account.updateDeviceSelector)
+
+                if account.poller.due():
+                    lstDue.append(account)
+
+            #Shared scheduler: the most overdue accounts first, a limited number per heartbeat
+            if not _spotifyApi.breaker.isOpen():
+                lstDue.sort(key=lambda account: account.poller.nextPoll)
+                for account in lstDue[:POLL_MAX_PER_HEARTBEAT]:
+                    account.poller.dispatched()
+                    self.commandQueue.put(('poll', account.index), account.pollPlayback)
+
+            #Favourites are indexed one page per heartbeat on one shared key, commands keep the other workers
+            if FAVOURITES_INDEX and time.time() >= self.favouritesAfter:
+                lstAccounts = self.activeAccounts()
+                account = next((account for account in lstAccounts if account.favouritesRefresh), None)
+                if account is None:
+                    account = next((account for account in lstAccounts if not account.favourites.isFresh() and account.favourites.mayRefresh()), None)
+                    if account is not None:
+                        account.startFavouritesRefresh()
+                if account is not None:
+                    self.commandQueue.put('favourites', account.refreshFavouritesPage)
+
+            if self.revalidateAt is not None and time.time() >= self.revalidateAt:
+                self.revalidateAt = time.time() + WARM_START_RETRY
+                self.commandQueue.put('revalidate', self.revalidate)
+
+            #Only written when tokens or devices changed, the playback state is saved by onStop
+            if self.stateSnapshot:
+                self.stateSnapshot.save(self.snapshot(False))
+
+            if _metrics.due():
+                self.reportStatistics()
+            
+            return True
+
+    def localPlaybackChanged(self):
+        #Called from the listener thread, fetch the new playback state right away
+        if _spotifyApi.breaker.isOpen():
+            return
+        for account in self.activeAccounts():
+            if account.poller.changed():
+                self.commandQueue.put(('poll', account.index), account.pollPlayback)
+
+    def onConnect(self, Connection, Status, Description):
+        if isinstance(_httpPool, DomoticzTransport):
+            _httpPool.onConnect(Connection, Status, Description)
+
+    def onMessage(self, Connection, Data):
+        if isinstance(_httpPool, DomoticzTransport):
+            _httpPool.onMessage(Connection, Data)
+
+    def onDisconnect(self, Connection):
+        if isinstance(_httpPool, DomoticzTransport):
+            _httpPool.onDisconnect(Connection)
+
+    def reportStatistics(self):
+        strSummary = _metrics.summary()
+        intCalls, intErrors, floatAvgMs = _metrics.totals()
+        _metrics.reset()
+
+        _log.info('plugin', 'Spotify statistics: %s', strSummary)
+        self.updateDomoticzDevice(STATISTICSTEXT, 0, strSummary)
+        self.updateDomoticzDevice(STATISTICSCALLS, 0, str(intCalls))
+        self.updateDomoticzDevice(STATISTICSLATENCY, 0, '%.0f' % (floatAvgMs))
+
+    def updateDomoticzDevice(self, idx, nValue, sValue):
+        #Devices removed by the user are no longer updated
+        if idx not in Devices:
+            return
+        if Devices[idx].sValue != sValue or Devices[idx].nValue != nValue:
+            _log.debug('domoticz', 'Update for device %s with nValue: %s and sValue %s', idx, nValue, sValue)
+            Devices[idx].Update(nValue, sValue)
+
+            
+
+    def onCommand(self, Unit, Command, Level, Hue):
+        _log.debug('plugin', "Spotify: onCommand called for Unit %s: Parameter '%s', Level: %s", Unit, Command, Level)
+        if Unit in Devices:
+            _log.debug('plugin', 'nValue=%s, sValue=%s', Devices[Unit].nValue, Devices[Unit].sValue)
+
+        if self.blStarting:
+            _log.error('plugin', "Spotify plugin is still starting, command ignored")
+            return
+
+        account = self.accountForUnit(Unit)
+        if account is None:
+            return
+        #Newer commands for the same unit replace the ones still waiting in the queue
+        if Unit == account.unit(SPOTIFYDEVICES):
+            self.commandQueue.put(('command', Unit), account.handleCommand, Unit, Command, Level)
+        elif Unit in (account.unit(VOLUME), account.unit(SEEK)):
+            #Dragging a slider sends a burst of levels, only the last one goes to spotify
+            self.commandQueue.debounce(('command', Unit), COMMAND_DEBOUNCE, account.handleTransport, Unit, Command, Level)
+        elif Unit in (account.unit(SHUFFLE), account.unit(REPEAT), account.unit(NEXT), account.unit(PREVIOUS)):
+            self.commandQueue.put(('command', Unit), account.handleTransport, Unit, Command, Level)
 
             
 
@@ -530,37 +2771,43 @@ _plugin = BasePlugin()
 def onStart():
     _plugin.onStart()
 
+def onStop():
+    _plugin.onStop()
+
 def onHeartbeat():
     _plugin.onHeartbeat()
 
 def onCommand(Unit, Command, Level, Hue):
     _plugin.onCommand(Unit, Command, Level, Hue)
 
+def onConnect(Connection, Status, Description):
+    _plugin.onConnect(Connection, Status, Description)
+
+def onMessage(Connection, Data):
+    _plugin.onMessage(Connection, Data)
+
+def onDisconnect(Connection):
+    _plugin.onDisconnect(Connection)
+
 
 #############################################################################
 #                         Domoticz helper functions                         #
 #############################################################################
 
-def catchDeviceSelectorLvl(name):
-    lstSelectorNames = Devices[SPOTIFYDEVICES].Options['LevelNames'].split('|')
-    lstSelectorLevel = str(lstSelectorNames.index(name)*10)
-    return lstSelectorLevel
-    
-
-def DomoticzAPI(APICall, blDebug):
+def DomoticzAPI(APICall):
     resultJson = None
     url = "http://{}:{}/json.htm?{}".format(Parameters["Address"], Parameters["Port"], urllib.parse.urlencode(APICall, safe="&="))
-    if blDebug:
-        Domoticz.Log("Calling domoticz API: {}".format(url))
+    _log.debug('domoticz', 'Calling domoticz API: %s', url)
+    start = time.time()
     try:
-        req = urllib.request.Request(url)
+        headers = {}
         if Parameters["Username"] != "":
-            Domoticz.Debug("Add authentification for user {}".format(Parameters["Username"]))
+            _log.debug('domoticz', 'Add authentification for user %s', Parameters["Username"])
             credentials = ('%s:%s' % (Parameters["Username"], Parameters["Password"]))
             encoded_credentials = base64.b64encode(credentials.encode('ascii'))
-            req.add_header('Authorization', 'Basic %s' % encoded_credentials.decode("ascii"))
+            headers['Authorization'] = 'Basic %s' % encoded_credentials.decode("ascii")
 
-        response = urllib.request.urlopen(req)
+        response = _httpPool.request('GET', url, headers=headers)
 
         if response.status == 200:
             resultJson = json.loads(response.read().decode('utf-8'))
@@ -568,7 +2815,9 @@ def DomoticzAPI(APICall, blDebug):
                 raise Exception("Domoticz API returned an error: status = {}".format(resultJson["status"]))
         else:
             raise Exception("Domoticz API: http error = {}".format(response.status))
+        _metrics.record('GET json.htm ' + APICall.get('param', ''), response.status, time.time() - start)
     except:
+        _metrics.record('GET json.htm ' + APICall.get('param', ''), 'error', time.time() - start)
         raise Exception("Error calling '{}'".format(url))
     
     return resultJson
@@ -582,7 +2831,7 @@ def DomoticzAPI(APICall, blDebug):
 #                       Local test helpers                                  #
 #############################################################################
 
-if local:
+if local and __name__ == "__main__":
     onStart()
 
     #onHeartbeat()